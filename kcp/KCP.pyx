@@ -1,13 +1,21 @@
 from cpython.bytes cimport PyBytes_FromStringAndSize
+from cpython.mem cimport PyMem_Malloc, PyMem_Realloc, PyMem_Free
 from cpython.pycapsule cimport *
-from libc.stdint cimport uint32_t, int32_t
+from cpython cimport array
+from libc.errno cimport errno, EAGAIN, EIO
+from libc.stdint cimport uint8_t, uint16_t, uint32_t, uint64_t, int32_t, int64_t
+from libc.stdlib cimport malloc, calloc, realloc, free
+from libc.string cimport memcmp, memcpy, memmove, memset, strerror
 from posix.time cimport clock_gettime, timespec, CLOCK_REALTIME
+from posix.fcntl cimport open, O_RDWR, O_CREAT, O_TRUNC
+from posix.mman cimport mmap, munmap, PROT_READ, PROT_WRITE, MAP_SHARED, MAP_FAILED
+from posix.unistd cimport close, ftruncate
 
 cdef extern from 'stdio.h':
     int printf(char *format, ...);
 
 
-cdef extern from "../ikcp/ikcp.h":
+cdef extern from "../ikcp/ikcp.h" nogil:
     ctypedef uint32_t ISTDUINT32;  #for linux
     ctypedef int32_t ISTDINT32;  #for linux
     ctypedef ISTDINT32 IINT32;
@@ -39,6 +47,7 @@ cdef extern from "../ikcp/ikcp.h":
         char *buffer;
         int fastresend;
         int nocwnd;
+        int stream;
         int logmask;
         int (*output)(const char *buf, int len, IKCPCB *kcp, void *user);
         void (*writelog)(const char *log, IKCPCB *kcp, void *user);
@@ -55,33 +64,1267 @@ cdef extern from "../ikcp/ikcp.h":
     int ikcp_wndsize(ikcpcb *kcp, int sndwnd, int rcvwnd);
     int ikcp_nodelay(ikcpcb *kcp, int nodelay, int interval, int resend, int nc);
     int ikcp_peeksize(const ikcpcb *kcp);
+    int ikcp_waitsnd(const ikcpcb *kcp);
     int ikcp_setmtu(ikcpcb *kcp, int mtu)
     void ikcp_setoutput(ikcpcb *kcp, int (*output)(const char *buf, int len, ikcpcb *kcp, void *user));
     IUINT32 ikcp_getconv(const void *ptr);
+    void ikcp_allocator(void* (*new_malloc)(size_t), void (*new_free)(void*));
 
 
+cdef extern from "<sys/uio.h>" nogil:
+    struct iovec:
+        void *iov_base
+        size_t iov_len
 
-cdef int output_wrapper(const char *buf, int length, ikcpcb *ikcp, void *user):
+
+cdef extern from "<sys/socket.h>" nogil:
+    ctypedef unsigned int socklen_t
+    enum: AF_INET, AF_INET6, MSG_DONTWAIT, MSG_TRUNC, SOL_SOCKET
+
+    struct sockaddr_storage:
+        pass
+
+    struct msghdr:
+        void *msg_name
+        socklen_t msg_namelen
+        iovec *msg_iov
+        size_t msg_iovlen
+        void *msg_control
+        size_t msg_controllen
+        int msg_flags
+
+    struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+
+    struct cmsghdr:
+        size_t cmsg_len
+        int cmsg_level
+        int cmsg_type
+
+    cmsghdr *CMSG_FIRSTHDR(msghdr *msg)
+    cmsghdr *CMSG_NXTHDR(msghdr *msg, cmsghdr *cmsg)
+    unsigned char *CMSG_DATA(cmsghdr *cmsg)
+    size_t CMSG_SPACE(size_t length)
+    size_t CMSG_LEN(size_t length)
+
+    int sendmmsg(int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags)
+    int recvmmsg(int sockfd, mmsghdr *msgvec, unsigned int vlen, int flags, timespec *timeout)
+
+
+cdef extern from *:
+    """
+    #include <netinet/udp.h>
+    #ifndef SOL_UDP
+    #define SOL_UDP 17
+    #endif
+    #ifndef UDP_SEGMENT
+    #define UDP_SEGMENT 103
+    #endif
+    #ifndef UDP_GRO
+    #define UDP_GRO 104
+    #endif
+    #ifndef SO_RXQ_OVFL
+    #define SO_RXQ_OVFL 40
+    #endif
+    """
+    enum: SOL_UDP, UDP_SEGMENT, UDP_GRO, SO_RXQ_OVFL
+
+
+cdef extern from "<netinet/in.h>" nogil:
+    struct in_addr:
+        pass
+
+    struct in6_addr:
+        pass
+
+    struct sockaddr_in:
+        int sin_family
+        uint16_t sin_port
+        in_addr sin_addr
+
+    struct sockaddr_in6:
+        int sin6_family
+        uint16_t sin6_port
+        uint32_t sin6_flowinfo
+        in6_addr sin6_addr
+        uint32_t sin6_scope_id
+
+    uint16_t htons(uint16_t hostshort)
+    uint32_t htonl(uint32_t hostlong)
+    uint16_t ntohs(uint16_t netshort)
+    uint32_t ntohl(uint32_t netlong)
+
+
+cdef extern from "<arpa/inet.h>" nogil:
+    enum: INET6_ADDRSTRLEN
+    int inet_pton(int af, const char *src, void *dst)
+    const char *inet_ntop(int af, const void *src, char *dst, socklen_t size)
+
+
+cdef extern from * nogil:
+    uint64_t __sync_fetch_and_add(uint64_t *ptr, uint64_t value)
+    int __builtin_popcountll(unsigned long long value)
+
+
+cdef extern from "<pthread.h>" nogil:
+    ctypedef unsigned long pthread_t
+    ctypedef struct pthread_mutex_t:
+        pass
+    ctypedef struct pthread_cond_t:
+        pass
+    int pthread_create(pthread_t *thread, const void *attr, void *(*start)(void *) nogil, void *arg)
+    int pthread_detach(pthread_t thread)
+    int pthread_mutex_init(pthread_mutex_t *mutex, const void *attr)
+    int pthread_mutex_lock(pthread_mutex_t *mutex)
+    int pthread_mutex_unlock(pthread_mutex_t *mutex)
+    int pthread_cond_init(pthread_cond_t *cond, const void *attr)
+    int pthread_cond_wait(pthread_cond_t *cond, pthread_mutex_t *mutex)
+    int pthread_cond_broadcast(pthread_cond_t *cond)
+    int pthread_cond_signal(pthread_cond_t *cond)
+
+
+# ikcp_send rejects messages of IKCP_WND_RCV (128) fragments or more
+DEF MAX_FRAGMENTS = 127
+DEF BATCH_PACKETS = 64
+DEF BATCH_BYTES = 131072
+# udp segmentation offload limits: segments per send and bytes per datagram
+DEF GSO_SEGMENTS = 64
+DEF GSO_BYTES = 65000
+# room for two cmsgs carrying an int each, in uint64_t for alignment
+DEF CONTROL_WORDS = 8
+DEF SLAB_BYTES = 65536
+DEF SLAB_CLASSES = 6
+# groups smaller than this are not worth waking the engine threads for
+DEF PARALLEL_MIN = 64
+
+# packets emitted by one KCP during update/flush in socket output mode.
+# only one KCP runs at a time per thread, so every thread shares one staging
+# area between its KCPs: loop_batch for the event loop, one per engine thread.
+# with gso, runs of equally sized packets are merged into one UDP_SEGMENT send,
+# segments holds the number of packets each message carries.
+ctypedef struct Batch:
+    char data[BATCH_BYTES]
+    mmsghdr msgs[BATCH_PACKETS]
+    iovec iov[BATCH_PACKETS]
+    uint64_t control[BATCH_PACKETS * CONTROL_WORDS]
+    uint16_t segments[BATCH_PACKETS]
+    unsigned int count
+    size_t offset
+
+# congestion control. a controller replaces ikcp's cwnd logic, which is turned
+# off with nocwnd: kcp_input tells it how many segments each packet acknowledged
+# and the lowest rtt of the acks it carried, and the controller answers with a
+# send window and a pacing rate that the session's pacer applies. controllers
+# are CongestionOps published as capsules in CONGESTION_CONTROLS.
+cdef struct Congestion
+
+ctypedef struct CongestionOps:
+    size_t size
+    void (*init)(Congestion *cc) nogil
+    void (*on_ack)(Congestion *cc, ikcpcb *ckcp, IUINT32 now, IUINT32 acked, IINT32 rtt) nogil
+
+cdef struct Congestion:
+    const CongestionOps *ops
+    void *state
+    IUINT32 cwnd
+    double pacing_rate
+    int nocwnd
+
+ctypedef struct Pacer:
+    double cap
+    double tokens
+    IUINT32 last
+    IUINT32 snd_wnd
+    IINT32 min_rtt
+    Congestion *cc
+    char *data
+    size_t head, tail, capacity
+
+ctypedef struct Tuner:
+    IUINT32 min_wnd, max_snd, max_rcv
+    IUINT32 last
+    IUINT32 snd_una, rcv_nxt
+
+# forward error correction. with set_fec every packet a session sends becomes
+# a data shard, and after each group of `data` shards `parity` Reed-Solomon
+# parity shards over GF(256) are sent too. the parity rows form a Cauchy
+# matrix, so any `data` shards of a group rebuild its missing data shards
+# without waiting for a retransmission. packets carry the conv, a shard
+# sequence number and a flag ahead of the shard, data shards hold the size
+# and the kcp packet, and parity is accumulated as data shards go out.
+# parity shards carry the number of data shards of their group in the high
+# byte of the flag: a group holding data is closed early once the session has
+# nothing more to send, so the tail of a burst is covered too, and the
+# receiver counts the shards that were never sent as zero shards. such a
+# group of n data shards sends at most n parity shards, so a single packet
+# burst costs one parity packet more and not `parity`.
+# received shards of the last FEC_GROUPS groups are kept for recovery.
+DEF FEC_HEADER = 10
+DEF FEC_OVERHEAD = 12
+DEF FEC_DATA = 0xf1
+DEF FEC_PARITY = 0xf2
+DEF FEC_MAX_SHARDS = 64
+DEF FEC_GROUPS = 4
+
+ctypedef struct FecGroup:
+    uint32_t id
+    uint64_t received
+    size_t size
+    bint done
+
+ctypedef struct Fec:
+    int data, parity
+    uint32_t conv
+    size_t stride
+    uint8_t *matrix
+    uint32_t seqid
+    size_t parity_size
+    bint pending
+    char *packet
+    char *parity_packets
+    char *shards
+    char *recovered
+    unsigned long recovered_count
+    FecGroup groups[FEC_GROUPS]
+
+ctypedef struct OutputSocket:
+    int fd
+    bint gso
+    sockaddr_storage address
+    socklen_t address_len
+    unsigned long dropped
+    Batch *batch
+    Pacer *pacer
+    Tuner *tuner
+    Fec *fec
+
+cdef Batch loop_batch
+
+
+
+# packet trace. every kcp segment that goes in or out is written as a fixed
+# size record to a ring in a shared file mapping, see kcp/trace.py for the
+# layout and the decoder. the segment headers are read from the wire instead
+# of ikcp's log hook, which formats text and has no events for output.
+ctypedef struct TraceHeader:
+    char magic[8]
+    uint32_t version
+    uint32_t record_size
+    uint64_t capacity
+    uint64_t head
+
+ctypedef struct TraceRecord:
+    uint64_t time
+    uint32_t conv
+    uint32_t sn
+    uint32_t una
+    uint32_t ts
+    uint16_t wnd
+    uint16_t length
+    uint8_t cmd
+    uint8_t frg
+    uint8_t direction
+    uint8_t pad
+
+DEF TRACE_IN = 0
+DEF TRACE_OUT = 1
+
+cdef TraceHeader *trace_ring = NULL
+cdef size_t trace_size = 0
+
+
+cdef inline uint32_t decode32(const char *p) nogil:
+    return (<uint8_t> p[0]) | (<uint8_t> p[1]) << 8 | (<uint8_t> p[2]) << 16 | (<uint32_t> <uint8_t> p[3]) << 24
+
+
+cdef void trace_packet(const char *data, long size, uint8_t direction) nogil:
+    cdef TraceHeader *ring = trace_ring
+    cdef TraceRecord *records = <TraceRecord *> (ring + 1)
+    cdef TraceRecord *record
+    cdef timespec now
+    cdef uint64_t time
+    cdef uint32_t length
+    clock_gettime(CLOCK_REALTIME, &now)
+    time = now.tv_sec * 1000000 + now.tv_nsec // 1000
+    while size >= 24:
+        record = &records[__sync_fetch_and_add(&ring.head, 1) % ring.capacity]
+        length = decode32(data + 20)
+        record.time = time
+        record.conv = decode32(data)
+        record.cmd = <uint8_t> data[4]
+        record.frg = <uint8_t> data[5]
+        record.wnd = (<uint8_t> data[6]) | (<uint8_t> data[7]) << 8
+        record.ts = decode32(data + 8)
+        record.sn = decode32(data + 12)
+        record.una = decode32(data + 16)
+        record.length = <uint16_t> length
+        record.direction = direction
+        record.pad = 0
+        if length > <uint32_t> (size - 24):
+            break
+        data += 24 + length
+        size -= 24 + length
+
+
+cdef inline int kcp_input(ikcpcb *ckcp, OutputSocket *sock, const char *data, long size) nogil:
+    if sock.fec != NULL:
+        return fec_input(ckcp, sock, data, size)
+    return segment_input(ckcp, sock, data, size)
+
+
+cdef int segment_input(ikcpcb *ckcp, OutputSocket *sock, const char *data, long size) nogil:
+    if trace_ring != NULL:
+        trace_packet(data, size, TRACE_IN)
+    if sock.pacer != NULL and sock.pacer.cc != NULL:
+        return congestion_input(ckcp, sock.pacer, data, size)
+    return ikcp_input(ckcp, data, size)
+
+
+def trace_start(path, unsigned long records=1 << 20):
+    """start writing every segment in or out of this process to a ring of records in file path"""
+    global trace_ring, trace_size
+    cdef bytes name = path.encode()
+    cdef size_t size = sizeof(TraceHeader) + records * sizeof(TraceRecord)
+    cdef int fd
+    cdef void *mapping
+    if trace_ring != NULL:
+        raise RuntimeError('trace already started')
+    if records == 0:
+        raise ValueError('records must be positive')
+    fd = open(name, O_RDWR | O_CREAT | O_TRUNC, 0o644)
+    if fd < 0:
+        raise OSError(errno, strerror(errno).decode(), path)
+    if ftruncate(fd, size) != 0:
+        close(fd)
+        raise OSError(errno, strerror(errno).decode(), path)
+    mapping = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0)
+    close(fd)
+    if mapping == MAP_FAILED:
+        raise OSError(errno, strerror(errno).decode(), path)
+    memcpy((<TraceHeader *> mapping).magic, b'KCPTRACE', 8)
+    (<TraceHeader *> mapping).version = 1
+    (<TraceHeader *> mapping).record_size = sizeof(TraceRecord)
+    (<TraceHeader *> mapping).capacity = records
+    (<TraceHeader *> mapping).head = 0
+    trace_size = size
+    trace_ring = <TraceHeader *> mapping
+
+
+def trace_stop():
+    global trace_ring, trace_size
+    if trace_ring != NULL:
+        munmap(trace_ring, trace_size)
+        trace_ring = NULL
+        trace_size = 0
+
+
+cdef int output_wrapper(const char *buf, int length, ikcpcb *ikcp, void *user) with gil:
     cdef object kcp = <object> user
-    cdef bytes o = PyBytes_FromStringAndSize(buf, length)
-    kcp.output(o)
+    cdef Fec *fec = (<KCP> kcp).sock.fec
+    cdef int parity
+    if trace_ring != NULL:
+        trace_packet(buf, length, TRACE_OUT)
+    if fec == NULL:
+        kcp.output(PyBytes_FromStringAndSize(buf, length))
+        return 1
+    parity = fec_encode(fec, buf, length)
+    if parity < 0:
+        return -1
+    kcp.output(PyBytes_FromStringAndSize(fec.packet, FEC_OVERHEAD + length))
+    output_parity(user, parity)
     return 1
 
+
+cdef void output_parity(void *user, int parity) with gil:
+    cdef object kcp = <object> user
+    cdef Fec *fec = (<KCP> kcp).sock.fec
+    cdef int i
+    for i in range(parity):
+        kcp.output(PyBytes_FromStringAndSize(fec.parity_packets + i * (FEC_HEADER + fec.stride),
+                                             FEC_HEADER + fec.parity_size))
+
+cdef socklen_t to_sockaddr(tuple address, sockaddr_storage *storage) except 0:
+    cdef sockaddr_in *sin
+    cdef sockaddr_in6 *sin6
+    cdef bytes host = address[0].encode()
+    memset(storage, 0, sizeof(sockaddr_storage))
+    if len(address) == 2:
+        sin = <sockaddr_in *> storage
+        sin.sin_family = AF_INET
+        sin.sin_port = htons(address[1])
+        if inet_pton(AF_INET, host, &sin.sin_addr) != 1:
+            raise ValueError('invalid IPv4 address: {}'.format(address[0]))
+        return sizeof(sockaddr_in)
+    sin6 = <sockaddr_in6 *> storage
+    sin6.sin6_family = AF_INET6
+    sin6.sin6_port = htons(address[1])
+    sin6.sin6_flowinfo = htonl(address[2])
+    sin6.sin6_scope_id = address[3]
+    if inet_pton(AF_INET6, host, &sin6.sin6_addr) != 1:
+        raise ValueError('invalid IPv6 address: {}'.format(address[0]))
+    return sizeof(sockaddr_in6)
+
+
+cdef tuple from_sockaddr(sockaddr_storage *storage):
+    cdef sockaddr_in *sin = <sockaddr_in *> storage
+    cdef sockaddr_in6 *sin6
+    cdef char host[INET6_ADDRSTRLEN]
+    if sin.sin_family == AF_INET:
+        inet_ntop(AF_INET, &sin.sin_addr, host, INET6_ADDRSTRLEN)
+        return host.decode(), ntohs(sin.sin_port)
+    sin6 = <sockaddr_in6 *> storage
+    inet_ntop(AF_INET6, &sin6.sin6_addr, host, INET6_ADDRSTRLEN)
+    return host.decode(), ntohs(sin6.sin6_port), ntohl(sin6.sin6_flowinfo), sin6.sin6_scope_id
+
+
+cdef unsigned int batch_segment(Batch *batch) nogil:
+    """
+    merge runs of equally sized packets, the last one of a run may be shorter, into
+    messages sent with UDP_SEGMENT. the packets are contiguous in data so a run
+    becomes one iovec. returns the number of messages.
+    """
+    cdef unsigned int i = 0
+    cdef unsigned int count = 0
+    cdef size_t size, total, length
+    cdef uint16_t segments
+    cdef cmsghdr *cmsg
+    cdef msghdr *hdr
+    while i < batch.count:
+        size = batch.iov[i].iov_len
+        total = size
+        segments = 1
+        i += 1
+        while (i < batch.count and segments < GSO_SEGMENTS and batch.iov[i].iov_len <= size
+               and total + batch.iov[i].iov_len <= GSO_BYTES):
+            length = batch.iov[i].iov_len
+            total += length
+            segments += 1
+            i += 1
+            if length < size:
+                break
+        batch.iov[count].iov_base = batch.iov[i - segments].iov_base
+        batch.iov[count].iov_len = total
+        batch.segments[count] = segments
+        hdr = &batch.msgs[count].msg_hdr
+        hdr.msg_iov = &batch.iov[count]
+        if segments > 1:
+            hdr.msg_control = &batch.control[count * CONTROL_WORDS]
+            hdr.msg_controllen = CMSG_SPACE(sizeof(uint16_t))
+            cmsg = CMSG_FIRSTHDR(hdr)
+            cmsg.cmsg_level = SOL_UDP
+            cmsg.cmsg_type = UDP_SEGMENT
+            cmsg.cmsg_len = CMSG_LEN(sizeof(uint16_t))
+            (<uint16_t *> CMSG_DATA(cmsg))[0] = <uint16_t> size
+        else:
+            hdr.msg_control = NULL
+            hdr.msg_controllen = 0
+        count += 1
+    return count
+
+
+cdef void batch_send(OutputSocket *sock) nogil:
+    cdef Batch *batch = sock.batch
+    cdef unsigned int i
+    cdef int n
+    cdef unsigned int sent = 0
+    cdef unsigned int count = batch.count
+    if sock.gso and count > 1:
+        count = batch_segment(batch)
+    else:
+        for i in range(count):
+            batch.segments[i] = 1
+    for i in range(count):
+        batch.msgs[i].msg_hdr.msg_name = &sock.address if sock.address_len else NULL
+        batch.msgs[i].msg_hdr.msg_namelen = sock.address_len
+    while sent < count:
+        n = sendmmsg(sock.fd, &batch.msgs[sent], count - sent, 0)
+        if n <= 0:
+            if errno == EIO and sock.gso:
+                # the route's device can not segment, keep sending packet by packet
+                sock.gso = False
+            # socket buffer full or peer unreachable, leave it to kcp retransmission
+            for i in range(sent, count):
+                sock.dropped += batch.segments[i]
+            break
+        sent += n
+    batch.count = 0
+    batch.offset = 0
+
+
+cdef int batch_stage(OutputSocket *sock, const char *buf, int length) nogil:
+    cdef Fec *fec = sock.fec
+    cdef int parity
+    if trace_ring != NULL:
+        trace_packet(buf, length, TRACE_OUT)
+    if fec == NULL:
+        return batch_put(sock, buf, length)
+    parity = fec_encode(fec, buf, length)
+    if parity < 0:
+        return -1
+    batch_put(sock, fec.packet, FEC_OVERHEAD + length)
+    batch_parity(sock, parity)
+    return 0
+
+
+cdef void batch_parity(OutputSocket *sock, int parity) nogil:
+    cdef Fec *fec = sock.fec
+    cdef int i
+    for i in range(parity):
+        batch_put(sock, fec.parity_packets + i * (FEC_HEADER + fec.stride), FEC_HEADER + fec.parity_size)
+
+
+cdef int batch_put(OutputSocket *sock, const char *buf, int length) nogil:
+    cdef Batch *batch = sock.batch
+    if batch.count == BATCH_PACKETS or batch.offset + length > BATCH_BYTES:
+        batch_send(sock)
+    if length > BATCH_BYTES:
+        return -1
+    memcpy(&batch.data[batch.offset], buf, length)
+    batch.iov[batch.count].iov_base = &batch.data[batch.offset]
+    batch.iov[batch.count].iov_len = length
+    batch.msgs[batch.count].msg_hdr.msg_iov = &batch.iov[batch.count]
+    batch.msgs[batch.count].msg_hdr.msg_iovlen = 1
+    batch.msgs[batch.count].msg_hdr.msg_control = NULL
+    batch.msgs[batch.count].msg_hdr.msg_controllen = 0
+    batch.count += 1
+    batch.offset += length
+    return 0
+
+
+cdef int batch_output(const char *buf, int length, ikcpcb *ikcp, void *user) nogil:
+    cdef OutputSocket *sock = <OutputSocket *> user
+    cdef Pacer *pacer = sock.pacer
+    cdef long offset = push_offset(buf, length) if pacer != NULL else -1
+    if offset < 0:
+        return batch_stage(sock, buf, length)
+    if pacer.head == pacer.tail:
+        pacer_refill(pacer, ikcp, ikcp.current)
+        if pacer.tokens >= length:
+            pacer.tokens -= length
+            return batch_stage(sock, buf, length)
+    if offset > 0:
+        batch_stage(sock, buf, offset)
+    if pacer_push(pacer, buf + offset, length - offset) < 0:
+        sock.dropped += 1
+    return 0
+
+
+# output pacing. packets carrying data leave through a token bucket filled at
+# PACING_GAIN windows per smoothed rtt, at most the configured cap. packets
+# over budget wait in a fifo that update_entries drains as tokens come back.
+# acks, probes and window updates are not paced: ikcp packs them ahead of the
+# data, so they are sent at once on their own and only the data waits. the
+# fifo is not bounded, instead the send window stops growing while it holds a
+# window of packets, so kcp sends no new data until it drains. with a cap the
+# send window is held to two capped rates times the lowest srtt seen, otherwise
+# a window queued behind the cap would wait past its rto and be sent again.
+DEF PACING_GAIN = 1.25
+DEF PACING_BURST_MS = 2
+DEF CMD_PUSH = 81
+DEF CMD_ACK = 82
+
+cdef inline long push_offset(const char *data, long size) nogil:
+    """offset of the first data segment in a packet, -1 when it has none"""
+    cdef uint32_t length
+    cdef long offset = 0
+    while size - offset >= 24:
+        if <uint8_t> data[offset + 4] == CMD_PUSH:
+            return offset
+        length = decode32(data + offset + 20)
+        if length > <uint32_t> (size - offset - 24):
+            break
+        offset += 24 + length
+    return -1
+
+
+cdef double pacing_rate(Pacer *pacer, ikcpcb *ckcp) nogil:
+    """bytes per ms, from the congestion controller when it has an estimate"""
+    cdef IUINT32 wnd = min(ckcp.snd_wnd, ckcp.rmt_wnd)
+    cdef IINT32 srtt = ckcp.rx_srtt if ckcp.rx_srtt > 0 else ckcp.rx_rto
+    cdef double rate
+    if pacer.cc != NULL and pacer.cc.pacing_rate > 0:
+        rate = pacer.cc.pacing_rate
+    else:
+        if ckcp.nocwnd == 0:
+            wnd = min(wnd, ckcp.cwnd)
+        rate = PACING_GAIN * max(wnd, 1) * ckcp.mtu / max(srtt, 1)
+    if pacer.cap > 0 and rate > pacer.cap:
+        rate = pacer.cap
+    return rate
+
+
+cdef void pacer_window(Pacer *pacer, ikcpcb *ckcp) nogil:
+    """
+    hold the send window to the configured one, the capped rate and the controller's
+    window, and to the segments in flight while the fifo holds a window of packets
+    """
+    cdef IUINT32 wnd = pacer.snd_wnd
+    if pacer.cap > 0 and ckcp.rx_srtt > 0:
+        if pacer.min_rtt == 0 or ckcp.rx_srtt < pacer.min_rtt:
+            pacer.min_rtt = ckcp.rx_srtt
+        wnd = min(wnd, <IUINT32> (2 * pacer.cap * pacer.min_rtt / ckcp.mss))
+    if pacer.cc != NULL and pacer.cc.cwnd > 0:
+        wnd = min(wnd, pacer.cc.cwnd)
+    if pacer.tail - pacer.head >= wnd * ckcp.mtu:
+        wnd = min(wnd, ckcp.snd_nxt - ckcp.snd_una)
+    ckcp.snd_wnd = max(wnd, 4)
+
+
+cdef void pacer_refill(Pacer *pacer, ikcpcb *ckcp, IUINT32 now) nogil:
+    cdef double rate, depth
+    cdef IINT32 elapsed = <IINT32> (now - pacer.last)
+    pacer_window(pacer, ckcp)
+    rate = pacing_rate(pacer, ckcp)
+    depth = max(2.0 * ckcp.mtu, rate * PACING_BURST_MS)
+    if pacer.last == 0:
+        pacer.tokens = depth
+    elif elapsed > 0:
+        pacer.tokens = min(depth, pacer.tokens + rate * elapsed)
+    pacer.last = now
+
+
+cdef int pacer_push(Pacer *pacer, const char *buf, int length) nogil:
+    """queue a packet, returns -1 when out of memory"""
+    cdef size_t need = sizeof(uint32_t) + length
+    cdef size_t capacity
+    cdef char *data
+    cdef uint32_t size = length
+    if pacer.tail + need > pacer.capacity:
+        memmove(pacer.data, pacer.data + pacer.head, pacer.tail - pacer.head)
+        pacer.tail -= pacer.head
+        pacer.head = 0
+    if pacer.tail + need > pacer.capacity:
+        capacity = max(max(2 * pacer.capacity, pacer.tail + need), <size_t> SLAB_BYTES)
+        data = <char *> realloc(pacer.data, capacity)
+        if data == NULL:
+            return -1
+        pacer.data = data
+        pacer.capacity = capacity
+    memcpy(pacer.data + pacer.tail, &size, sizeof(uint32_t))
+    memcpy(pacer.data + pacer.tail + sizeof(uint32_t), buf, length)
+    pacer.tail += need
+    return 0
+
+
+cdef void pacer_release(OutputSocket *sock, ikcpcb *ckcp, IUINT32 now) nogil:
+    """stage the queued packets the bucket has tokens for"""
+    cdef Pacer *pacer = sock.pacer
+    cdef uint32_t length
+    pacer_refill(pacer, ckcp, now)
+    while pacer.head < pacer.tail:
+        memcpy(&length, pacer.data + pacer.head, sizeof(uint32_t))
+        if pacer.tokens < length:
+            break
+        pacer.tokens -= length
+        batch_stage(sock, pacer.data + pacer.head + sizeof(uint32_t), length)
+        pacer.head += sizeof(uint32_t) + length
+    if pacer.head == pacer.tail:
+        pacer.head = pacer.tail = 0
+
+
+cdef IINT32 pacer_wait(Pacer *pacer, ikcpcb *ckcp) nogil:
+    """ms until the next queued packet may leave, -1 when nothing is queued"""
+    cdef uint32_t length
+    if pacer == NULL or pacer.head == pacer.tail:
+        return -1
+    memcpy(&length, pacer.data + pacer.head, sizeof(uint32_t))
+    return <IINT32> ((length - pacer.tokens) / pacing_rate(pacer, ckcp)) + 1
+
+
+cdef int congestion_input(ikcpcb *ckcp, Pacer *pacer, const char *data, long size) nogil:
+    """ikcp_input reporting the acknowledged segments and the ack rtt to the controller"""
+    cdef Congestion *cc = pacer.cc
+    cdef IUINT32 now = kcp_now()
+    cdef IUINT32 inflight = ckcp.nsnd_buf
+    cdef IINT32 rtt = -1
+    cdef IINT32 sample
+    cdef const char *segment = data
+    cdef long left = size
+    cdef uint32_t length
+    cdef int res
+    while left >= 24:
+        if <uint8_t> segment[4] == CMD_ACK:
+            sample = <IINT32> (now - decode32(segment + 8))
+            if sample >= 0 and (rtt < 0 or sample < rtt):
+                rtt = sample
+        length = decode32(segment + 20)
+        if length > <uint32_t> (left - 24):
+            break
+        segment += 24 + length
+        left -= 24 + length
+    res = ikcp_input(ckcp, data, size)
+    # input only takes acknowledged segments out of snd_buf
+    cc.ops.on_ack(cc, ckcp, now, inflight - ckcp.nsnd_buf, rtt)
+    pacer_window(pacer, ckcp)
+    return res
+
+
+# BBR style controller. the bottleneck bandwidth is the highest delivery rate of
+# the last BBR_BW_ROUNDS rounds, a round ending once everything sent when it
+# started has been acknowledged. rounds where the send queue ran empty only
+# count when they raise it. STARTUP doubles the rate every round
+# until it stops growing by a quarter for three rounds, DRAIN empties the queue
+# built meanwhile and PROBE_BW cycles the pacing gain around the estimate.
+# PROBE_RTT shrinks the window to four segments for BBR_PROBE_RTT_MS when the
+# min rtt has not been seen again for BBR_MIN_RTT_MS.
+DEF BBR_BW_ROUNDS = 10
+DEF BBR_MIN_RTT_MS = 10000
+DEF BBR_PROBE_RTT_MS = 200
+DEF BBR_INIT_CWND = 16
+DEF BBR_HIGH_GAIN = 2.885
+DEF BBR_STARTUP = 0
+DEF BBR_DRAIN = 1
+DEF BBR_PROBE_BW = 2
+DEF BBR_PROBE_RTT = 3
+cdef double BBR_CYCLE[8]
+BBR_CYCLE[:] = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+
+ctypedef struct BBR:
+    int mode
+    int cycle
+    int full_bw_rounds
+    bint app_limited
+    double full_bw
+    double btl_bw
+    double bw[BBR_BW_ROUNDS]
+    IUINT32 rounds
+    IUINT32 round_start
+    IUINT32 round_end
+    uint64_t delivered
+    uint64_t round_delivered
+    IINT32 min_rtt
+    IUINT32 min_rtt_stamp
+    IUINT32 probe_rtt_done
+
+
+cdef void bbr_init(Congestion *cc) nogil:
+    cdef BBR *bbr = <BBR *> cc.state
+    bbr.mode = BBR_STARTUP
+    cc.cwnd = BBR_INIT_CWND
+
+
+cdef void bbr_round(BBR *bbr, ikcpcb *ckcp) nogil:
+    if bbr.mode == BBR_STARTUP:
+        if bbr.btl_bw >= bbr.full_bw * 1.25:
+            bbr.full_bw = bbr.btl_bw
+            bbr.full_bw_rounds = 0
+        elif not bbr.app_limited:
+            bbr.full_bw_rounds += 1
+            if bbr.full_bw_rounds >= 3:
+                bbr.mode = BBR_DRAIN
+    elif bbr.mode == BBR_DRAIN:
+        if ckcp.nsnd_buf * ckcp.mss <= bbr.btl_bw * (bbr.min_rtt + ckcp.interval):
+            bbr.mode = BBR_PROBE_BW
+            bbr.cycle = 2
+    elif bbr.mode == BBR_PROBE_BW:
+        bbr.cycle = (bbr.cycle + 1) % 8
+
+
+cdef void bbr_ack(Congestion *cc, ikcpcb *ckcp, IUINT32 now, IUINT32 acked, IINT32 rtt) nogil:
+    cdef BBR *bbr = <BBR *> cc.state
+    cdef IINT32 elapsed
+    cdef double sample, pacing_gain, cwnd_gain
+    cdef int i
+    bbr.delivered += acked * ckcp.mss
+    if rtt >= 0 and (bbr.min_rtt == 0 or rtt <= bbr.min_rtt):
+        bbr.min_rtt = max(rtt, 1)
+        bbr.min_rtt_stamp = now
+    if bbr.min_rtt == 0:
+        return
+    if ckcp.nsnd_que == 0:
+        bbr.app_limited = True
+    if bbr.rounds == 0 and bbr.round_start == 0:
+        bbr.round_start = now
+        bbr.round_end = ckcp.snd_nxt
+    if <IINT32> (ckcp.snd_una - bbr.round_end) > 0:
+        elapsed = max(<IINT32> (now - bbr.round_start), bbr.min_rtt)
+        sample = (bbr.delivered - bbr.round_delivered) / <double> elapsed
+        if not bbr.app_limited or sample > bbr.btl_bw:
+            bbr.bw[bbr.rounds % BBR_BW_ROUNDS] = sample
+        else:
+            bbr.bw[bbr.rounds % BBR_BW_ROUNDS] = bbr.btl_bw
+        bbr.rounds += 1
+        bbr.round_start = now
+        bbr.round_end = ckcp.snd_nxt
+        bbr.round_delivered = bbr.delivered
+        bbr.btl_bw = 0
+        for i in range(BBR_BW_ROUNDS):
+            bbr.btl_bw = max(bbr.btl_bw, bbr.bw[i])
+        bbr_round(bbr, ckcp)
+        bbr.app_limited = False
+    if bbr.mode != BBR_PROBE_RTT and <IINT32> (now - bbr.min_rtt_stamp) > BBR_MIN_RTT_MS:
+        bbr.mode = BBR_PROBE_RTT
+        bbr.probe_rtt_done = now + max(BBR_PROBE_RTT_MS, bbr.min_rtt)
+        # the next samples, taken with an empty queue, set the new min rtt
+        bbr.min_rtt = max(rtt, 1) if rtt >= 0 else bbr.min_rtt
+        bbr.min_rtt_stamp = now
+    elif bbr.mode == BBR_PROBE_RTT and <IINT32> (now - bbr.probe_rtt_done) >= 0:
+        bbr.mode = BBR_PROBE_BW if bbr.full_bw_rounds >= 3 else BBR_STARTUP
+        bbr.cycle = 2
+    if bbr.btl_bw <= 0:
+        return
+    if bbr.mode == BBR_STARTUP:
+        pacing_gain = cwnd_gain = BBR_HIGH_GAIN
+    elif bbr.mode == BBR_DRAIN:
+        pacing_gain = 1 / BBR_HIGH_GAIN
+        cwnd_gain = BBR_HIGH_GAIN
+    elif bbr.mode == BBR_PROBE_BW:
+        pacing_gain = BBR_CYCLE[bbr.cycle]
+        cwnd_gain = 2
+    else:
+        pacing_gain = 1
+        cwnd_gain = 0
+    cc.pacing_rate = pacing_gain * bbr.btl_bw
+    # acks wait for the peer's next flush, up to one interval on top of the min rtt
+    cc.cwnd = max(<IUINT32> (cwnd_gain * bbr.btl_bw * (bbr.min_rtt + ckcp.interval) / ckcp.mss), 4)
+
+
+cdef CongestionOps bbr_ops
+bbr_ops.size = sizeof(BBR)
+bbr_ops.init = bbr_init
+bbr_ops.on_ack = bbr_ack
+
+CONGESTION_CONTROLS = {'bbr': PyCapsule_New(&bbr_ops, b'kcp.congestion', NULL)}
+
+# window auto tuning. every two srtt, at least AUTOTUNE_MS apart, each window
+# is set to twice the segments delivered in its direction per srtt and update
+# interval, the time acks take to come back. a window the transfer fills
+# doubles and one it does not use shrinks, by at most half for the receive
+# window since the peer may have sent into it.
+DEF AUTOTUNE_MS = 100
+
+
+cdef void set_windows(ikcpcb *ckcp, OutputSocket *sock, IUINT32 snd_wnd, IUINT32 rcv_wnd) nogil:
+    """ikcp_wndsize, keeping the pacer's copy of the send window"""
+    ikcp_wndsize(ckcp, snd_wnd, rcv_wnd)
+    if sock.pacer != NULL:
+        sock.pacer.snd_wnd = ckcp.snd_wnd
+
+
+cdef inline IUINT32 tuned_window(IUINT32 delivered, IUINT32 low, IUINT32 high) nogil:
+    return min(max(2 * delivered, low), high)
+
+
+cdef void autotune(OutputSocket *sock, ikcpcb *ckcp, IUINT32 now) nogil:
+    cdef Tuner *tuner = sock.tuner
+    cdef IINT32 srtt = ckcp.rx_srtt if ckcp.rx_srtt > 0 else ckcp.rx_rto
+    cdef IINT32 elapsed = <IINT32> (now - tuner.last)
+    cdef double round_trip = srtt + ckcp.interval
+    cdef IUINT32 snd_wnd, rcv_wnd
+    if elapsed < max(2 * srtt, AUTOTUNE_MS):
+        return
+    snd_wnd = tuned_window(<IUINT32> ((ckcp.snd_una - tuner.snd_una) * round_trip / elapsed),
+                           tuner.min_wnd, tuner.max_snd)
+    rcv_wnd = tuned_window(<IUINT32> ((ckcp.rcv_nxt - tuner.rcv_nxt) * round_trip / elapsed),
+                           max(tuner.min_wnd, ckcp.rcv_wnd // 2), tuner.max_rcv)
+    set_windows(ckcp, sock, snd_wnd, rcv_wnd)
+    tuner.last = now
+    tuner.snd_una = ckcp.snd_una
+    tuner.rcv_nxt = ckcp.rcv_nxt
+
+
+# Reed-Solomon coding of set_fec, see Fec.
+cdef uint8_t GF_EXP[510]
+cdef uint8_t GF_LOG[256]
+cdef uint8_t GF_MUL[256][256]
+
+
+cdef void gf_init():
+    cdef int x = 1
+    cdef int a, b
+    for a in range(255):
+        GF_EXP[a] = GF_EXP[a + 255] = x
+        GF_LOG[x] = a
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    for a in range(1, 256):
+        for b in range(1, 256):
+            GF_MUL[a][b] = GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+gf_init()
+
+
+cdef inline uint8_t gf_inv(uint8_t a) nogil:
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+cdef void gf_mul_add(uint8_t *dst, const uint8_t *src, uint8_t c, size_t size) nogil:
+    """dst += c * src"""
+    cdef const uint8_t *row = GF_MUL[c]
+    cdef size_t i
+    if c == 1:
+        for i in range(size):
+            dst[i] ^= src[i]
+    elif c:
+        for i in range(size):
+            dst[i] ^= row[src[i]]
+
+
+cdef bint gf_invert(uint8_t *matrix, uint8_t *inverse, int n) nogil:
+    """invert the n x n matrix into inverse by Gauss-Jordan elimination, matrix is destroyed"""
+    cdef int row, col, pivot, k
+    cdef uint8_t factor, swap
+    memset(inverse, 0, n * n)
+    for row in range(n):
+        inverse[row * n + row] = 1
+    for col in range(n):
+        pivot = col
+        while pivot < n and matrix[pivot * n + col] == 0:
+            pivot += 1
+        if pivot == n:
+            return False
+        if pivot != col:
+            for k in range(n):
+                swap = matrix[pivot * n + k]
+                matrix[pivot * n + k] = matrix[col * n + k]
+                matrix[col * n + k] = swap
+                swap = inverse[pivot * n + k]
+                inverse[pivot * n + k] = inverse[col * n + k]
+                inverse[col * n + k] = swap
+        factor = gf_inv(matrix[col * n + col])
+        for k in range(n):
+            matrix[col * n + k] = GF_MUL[factor][matrix[col * n + k]]
+            inverse[col * n + k] = GF_MUL[factor][inverse[col * n + k]]
+        for row in range(n):
+            factor = matrix[row * n + col]
+            if row != col and factor:
+                gf_mul_add(&matrix[row * n], &matrix[col * n], factor, n)
+                gf_mul_add(&inverse[row * n], &inverse[col * n], factor, n)
+    return True
+
+
+cdef inline void encode16(char *p, uint16_t value) nogil:
+    p[0] = <char> (value & 0xff)
+    p[1] = <char> (value >> 8)
+
+
+cdef inline void encode32(char *p, uint32_t value) nogil:
+    encode16(p, <uint16_t> (value & 0xffff))
+    encode16(p + 2, <uint16_t> (value >> 16))
+
+
+cdef inline uint16_t decode16(const char *p) nogil:
+    return (<uint8_t> p[0]) | (<uint16_t> <uint8_t> p[1]) << 8
+
+
+cdef inline char *fec_shard(Fec *fec, FecGroup *group, int index) nogil:
+    return fec.shards + ((group - fec.groups) * (fec.data + fec.parity) + index) * fec.stride
+
+
+cdef int fec_encode(Fec *fec, const char *buf, int length) nogil:
+    """
+    wrap the packet as the next data shard into fec.packet. returns the number
+    of parity packets completed with it in fec.parity_packets, -1 for a packet
+    over the mtu.
+    """
+    cdef int index = fec.seqid % (fec.data + fec.parity)
+    cdef size_t size = length + 2
+    cdef size_t packet_size = FEC_HEADER + fec.stride
+    cdef int i
+    if size > fec.stride:
+        return -1
+    if index == 0:
+        memset(fec.parity_packets, 0, fec.parity * packet_size)
+        fec.parity_size = 0
+        fec.pending = False
+    encode32(fec.packet, fec.conv)
+    encode32(fec.packet + 4, fec.seqid)
+    encode16(fec.packet + 8, FEC_DATA)
+    encode16(fec.packet + FEC_HEADER, <uint16_t> size)
+    memcpy(fec.packet + FEC_OVERHEAD, buf, length)
+    for i in range(fec.parity):
+        gf_mul_add(<uint8_t *> fec.parity_packets + i * packet_size + FEC_HEADER,
+                   <uint8_t *> fec.packet + FEC_HEADER, fec.matrix[i * fec.data + index], size)
+    fec.parity_size = max(fec.parity_size, size)
+    fec.pending = fec.pending or push_offset(buf, length) >= 0
+    fec.seqid += 1
+    if index + 1 < fec.data:
+        return 0
+    return fec_close(fec, fec.data)
+
+
+cdef int fec_close(Fec *fec, int count) nogil:
+    """
+    stamp the parity packets of the group after its count data shards. returns how many
+    to send, every one for a full group and at most count for a partial one.
+    """
+    cdef size_t packet_size = FEC_HEADER + fec.stride
+    cdef int i
+    fec.seqid += fec.data - count
+    fec.pending = False
+    for i in range(fec.parity):
+        encode32(fec.parity_packets + i * packet_size, fec.conv)
+        encode32(fec.parity_packets + i * packet_size + 4, fec.seqid)
+        encode16(fec.parity_packets + i * packet_size + 8, FEC_PARITY | count << 8)
+        fec.seqid += 1
+    return fec.parity if count == fec.data else min(fec.parity, count)
+
+
+cdef void fec_flush(OutputSocket *sock, ikcpcb *ckcp) nogil:
+    """send the parity of a group holding data early once the session has nothing more to send"""
+    cdef Fec *fec = sock.fec
+    cdef int parity
+    if fec == NULL or not fec.pending or ckcp.nsnd_que:
+        return
+    if sock.pacer != NULL and sock.pacer.head != sock.pacer.tail:
+        return
+    parity = fec_close(fec, fec.seqid % (fec.data + fec.parity))
+    if sock.fd >= 0:
+        batch_parity(sock, parity)
+    else:
+        output_parity(ckcp.user, parity)
+
+
+cdef bint fec_recover(ikcpcb *ckcp, OutputSocket *sock, FecGroup *group) nogil:
+    """rebuild the missing data shards of group from `data` of its shards and input them"""
+    cdef Fec *fec = sock.fec
+    cdef int n = fec.data
+    cdef int rows[FEC_MAX_SHARDS]
+    cdef uint8_t matrix[FEC_MAX_SHARDS * FEC_MAX_SHARDS]
+    cdef uint8_t inverse[FEC_MAX_SHARDS * FEC_MAX_SHARDS]
+    cdef uint8_t *shard = <uint8_t *> fec.recovered
+    cdef int count = 0
+    cdef int index, row, k
+    cdef size_t size
+    cdef bint taken = False
+    for index in range(n + fec.parity):
+        if count < n and group.received & (1ULL << index):
+            rows[count] = index
+            count += 1
+    memset(matrix, 0, n * n)
+    for row in range(n):
+        if rows[row] < n:
+            matrix[row * n + rows[row]] = 1
+        else:
+            memcpy(&matrix[row * n], &fec.matrix[(rows[row] - n) * n], n)
+    if not gf_invert(matrix, inverse, n):
+        return False
+    for index in range(n):
+        if group.received & (1ULL << index):
+            continue
+        memset(shard, 0, group.size)
+        for k in range(n):
+            gf_mul_add(shard, <uint8_t *> fec_shard(fec, group, rows[k]), inverse[index * n + k], group.size)
+        size = decode16(fec.recovered)
+        if 2 < size <= group.size:
+            fec.recovered_count += 1
+            if segment_input(ckcp, sock, fec.recovered + 2, size - 2) == 0:
+                taken = True
+    return taken
+
+
+cdef int fec_input(ikcpcb *ckcp, OutputSocket *sock, const char *data, long size) nogil:
+    """input the kcp packet of a data shard, and the data shards recovered with it"""
+    cdef Fec *fec = sock.fec
+    cdef uint32_t seqid, group_id
+    cdef uint16_t flag, length
+    cdef int index, i
+    cdef int count = 0
+    cdef uint64_t data_mask = (1ULL << fec.data) - 1
+    cdef FecGroup *group
+    cdef int res = -1
+    if size < FEC_HEADER + 2 or size - FEC_HEADER > <long> fec.stride:
+        return -1
+    seqid = decode32(data + 4)
+    flag = decode16(data + 8)
+    group_id = seqid // (fec.data + fec.parity)
+    index = seqid % (fec.data + fec.parity)
+    if flag == FEC_DATA:
+        length = decode16(data + FEC_HEADER)
+        if length < 2 or length > size - FEC_HEADER or index >= fec.data:
+            return -1
+    else:
+        count = flag >> 8
+        if flag & 0xff != FEC_PARITY or index < fec.data or count == 0 or count > fec.data:
+            return -1
+    group = &fec.groups[group_id % FEC_GROUPS]
+    if group.received == 0 or group.id != group_id:
+        if group.received and <int32_t> (group_id - group.id) < 0:
+            # the group's slot went to a newer one
+            if flag == FEC_DATA:
+                return segment_input(ckcp, sock, data + FEC_OVERHEAD, length - 2)
+            return -1
+        group.id = group_id
+        group.received = 0
+        group.size = 0
+        group.done = False
+    if group.received & (1ULL << index):
+        return -1
+    group.received |= 1ULL << index
+    if flag == FEC_DATA:
+        res = segment_input(ckcp, sock, data + FEC_OVERHEAD, length - 2)
+    if group.done:
+        return res
+    memcpy(fec_shard(fec, group, index), data + FEC_HEADER, size - FEC_HEADER)
+    memset(fec_shard(fec, group, index) + size - FEC_HEADER, 0, fec.stride - (size - FEC_HEADER))
+    if flag != FEC_DATA:
+        group.size = size - FEC_HEADER
+        for i in range(count, fec.data):
+            if not group.received & (1ULL << i):
+                memset(fec_shard(fec, group, i), 0, fec.stride)
+                group.received |= 1ULL << i
+    if group.received & data_mask == data_mask:
+        group.done = True
+    elif group.size and __builtin_popcountll(group.received) >= fec.data:
+        group.done = True
+        if fec_recover(ckcp, sock, group):
+            res = 0
+    return res
+
+
+# size classed slab allocator installed into ikcp at import. segments of a
+# few bytes (acks, probes, small writes) and of a full mss are carved out of
+# 64KiB slabs and recycled through per class free lists, larger blocks like
+# the control block buffers go to malloc. slabs are kept for the process lifetime.
+ctypedef struct BlockHeader:
+    size_t size
+    ssize_t klass
+
+cdef size_t slab_sizes[SLAB_CLASSES]
+slab_sizes[:] = [128, 256, 512, 1024, 1536, 2048]
+cdef void *slab_free_lists[SLAB_CLASSES]
+cdef size_t slab_count = 0
+cdef size_t live_bytes = 0
+cdef size_t peak_bytes = 0
+# only taken once engine threads exist
+cdef pthread_mutex_t slab_lock
+cdef bint threaded = False
+pthread_mutex_init(&slab_lock, NULL)
+
+
+cdef bint slab_grow(int klass) nogil:
+    global slab_count
+    cdef size_t block = slab_sizes[klass]
+    cdef char *slab = <char *> malloc(SLAB_BYTES)
+    cdef size_t offset = 0
+    if slab == NULL:
+        return False
+    while offset + block <= SLAB_BYTES:
+        (<void **> (slab + offset))[0] = slab_free_lists[klass]
+        slab_free_lists[klass] = slab + offset
+        offset += block
+    slab_count += 1
+    return True
+
+
+cdef void *slab_malloc(size_t size) nogil:
+    global live_bytes, peak_bytes
+    cdef size_t total = size + sizeof(BlockHeader)
+    cdef int klass = 0
+    cdef BlockHeader *header
+    while klass < SLAB_CLASSES and slab_sizes[klass] < total:
+        klass += 1
+    if klass == SLAB_CLASSES:
+        header = <BlockHeader *> malloc(total)
+        if header == NULL:
+            return NULL
+        klass = -1
+    if threaded:
+        pthread_mutex_lock(&slab_lock)
+    if klass >= 0:
+        if slab_free_lists[klass] == NULL and not slab_grow(klass):
+            if threaded:
+                pthread_mutex_unlock(&slab_lock)
+            return NULL
+        header = <BlockHeader *> slab_free_lists[klass]
+        slab_free_lists[klass] = (<void **> header)[0]
+    live_bytes += size
+    if live_bytes > peak_bytes:
+        peak_bytes = live_bytes
+    if threaded:
+        pthread_mutex_unlock(&slab_lock)
+    header.size = size
+    header.klass = klass
+    return header + 1
+
+
+cdef void slab_free(void *ptr) nogil:
+    global live_bytes
+    cdef BlockHeader *header
+    if ptr == NULL:
+        return
+    header = <BlockHeader *> ptr - 1
+    if header.klass < 0:
+        if threaded:
+            pthread_mutex_lock(&slab_lock)
+        live_bytes -= header.size
+        if threaded:
+            pthread_mutex_unlock(&slab_lock)
+        free(header)
+        return
+    if threaded:
+        pthread_mutex_lock(&slab_lock)
+    live_bytes -= header.size
+    (<void **> header)[0] = slab_free_lists[header.klass]
+    slab_free_lists[header.klass] = header
+    if threaded:
+        pthread_mutex_unlock(&slab_lock)
+
+
+ikcp_allocator(slab_malloc, slab_free)
+
+
+def allocator_stats():
+    """bytes allocated by ikcp in this process, their high-water mark and the slabs backing them"""
+    return {'live_bytes': live_bytes, 'peak_bytes': peak_bytes,
+            'slabs': slab_count, 'slab_bytes': slab_count * SLAB_BYTES}
+
+
+cdef inline bint kcp_idle(ikcpcb *ckcp) nogil:
+    """nothing to send, ack or probe, so updating would be a no-op"""
+    return (ckcp.nsnd_buf == 0 and ckcp.nsnd_que == 0 and ckcp.ackcount == 0
+            and ckcp.probe == 0 and ckcp.rmt_wnd != 0)
+
+
+STATS_FIELDS = ('conv', 'state', 'rx_srtt', 'rx_rttval', 'rx_rto', 'cwnd', 'ssthresh',
+                'snd_wnd', 'rcv_wnd', 'rmt_wnd', 'snd_una', 'snd_nxt', 'rcv_nxt',
+                'nsnd_que', 'nsnd_buf', 'nrcv_que', 'nrcv_buf', 'xmit', 'dropped', 'recovered')
+DEF STATS_SIZE = 20
+cdef array.array stats_template = array.array('q')
+
+
+cdef void fill_stats(ikcpcb *ckcp, OutputSocket *sock, int64_t *row) nogil:
+    """write the counters of STATS_FIELDS to row"""
+    row[0] = ckcp.conv
+    row[1] = <IINT32> ckcp.state
+    row[2] = ckcp.rx_srtt
+    row[3] = ckcp.rx_rttval
+    row[4] = ckcp.rx_rto
+    row[5] = ckcp.cwnd
+    row[6] = ckcp.ssthresh
+    row[7] = ckcp.snd_wnd
+    row[8] = ckcp.rcv_wnd
+    row[9] = ckcp.rmt_wnd
+    row[10] = ckcp.snd_una
+    row[11] = ckcp.snd_nxt
+    row[12] = ckcp.rcv_nxt
+    row[13] = ckcp.nsnd_que
+    row[14] = ckcp.nsnd_buf
+    row[15] = ckcp.nrcv_que
+    row[16] = ckcp.nrcv_buf
+    row[17] = ckcp.xmit
+    row[18] = sock.dropped
+    row[19] = sock.fec.recovered_count if sock.fec != NULL else 0
+
+
 cpdef uint32_t get_conv(const char *ptr):
     return ikcp_getconv(ptr)
 
-cpdef int kcp_now():
+cpdef IUINT32 kcp_now() nogil:
     cdef timespec ts
     cdef long current
     clock_gettime(CLOCK_REALTIME, &ts)
     current = ts.tv_sec * 1000 + (ts.tv_nsec / 1000000)
-    return current & 0xffffffff
+    return <IUINT32> (current & 0xffffffffUL)
 
 
 
 cdef class KCP:
     cdef ikcpcb *ckcp
     cdef public object output
+    cdef OutputSocket sock
 
     @property
     def conv(self):
@@ -89,35 +1332,111 @@ cdef class KCP:
 
     @property
     def state(self):
-        return self.ckcp.state
+        return <IINT32> self.ckcp.state
 
     @state.setter
     def state(self, int s):
         self.ckcp.state = s
 
+    @property
+    def idle(self):
+        return kcp_idle(self.ckcp)
+
+    @property
+    def mss(self):
+        return self.ckcp.mss
+
+    @property
+    def stream(self):
+        """in stream mode sends are appended to the last queued segment, messages are not kept apart"""
+        return bool(self.ckcp.stream)
+
+    @stream.setter
+    def stream(self, bint stream):
+        self.ckcp.stream = stream
+
+    @property
+    def dropped(self):
+        return self.sock.dropped
+
     def __cinit__(self, conv):
         self.ckcp = ikcp_create(conv, <void*> self)
+        self.sock.fd = -1
+        self.sock.batch = &loop_batch
 
     def __dealloc__(self):
+        self.set_pacing(False)
+        self.set_fec(0)
+        free(self.sock.tuner)
         ikcp_release(self.ckcp)
 
     cpdef int recv(self, char *buffer, int length):
         return ikcp_recv(self.ckcp, buffer, length)
 
+    cpdef int recv_into(self, unsigned char[::1] buffer):
+        """receive one message into a writable buffer, returns its size or a negative error like recv"""
+        if buffer.shape[0] == 0:
+            return -3 if ikcp_peeksize(self.ckcp) > 0 else -1
+        return ikcp_recv(self.ckcp, <char *> &buffer[0], buffer.shape[0])
+
+    cpdef int drain_into(self, unsigned char[::1] buffer):
+        """
+        receive every message of rcv_queue that fits into buffer, returns the number of bytes written.
+        empty messages are consumed too.
+        """
+        cdef ikcpcb *ckcp = self.ckcp
+        cdef int length = buffer.shape[0]
+        cdef int offset = 0
+        cdef char *data = <char *> &buffer[0] if length else NULL
+        cdef int size = ikcp_peeksize(ckcp)
+        while 0 <= size <= length - offset:
+            ikcp_recv(ckcp, data + offset, size)
+            offset += size
+            size = ikcp_peeksize(ckcp)
+        return offset
+
     cpdef int send(self, char *buffer, int length):
         return ikcp_send(self.ckcp, buffer, length)
 
+    cpdef int send_all(self, const unsigned char[::1] data):
+        """queue data of any size, split into messages within kcp's fragment limit"""
+        cdef ikcpcb *ckcp = self.ckcp
+        cdef int length = data.shape[0]
+        cdef int chunk = ckcp.mss * MAX_FRAGMENTS
+        cdef int offset = 0
+        cdef int size, res
+        while offset < length:
+            size = min(chunk, length - offset)
+            res = ikcp_send(ckcp, <const char *> &data[offset], size)
+            if res < 0:
+                return res
+            offset += size
+        return 0
+
     cpdef void update(self, IUINT32 current):
-        ikcp_update(self.ckcp, current)
+        with nogil:
+            if self.sock.pacer != NULL:
+                pacer_release(&self.sock, self.ckcp, current)
+            ikcp_update(self.ckcp, current)
+            fec_flush(&self.sock, self.ckcp)
+            if loop_batch.count:
+                batch_send(&self.sock)
 
     cpdef IUINT32 check(self, IUINT32 current):
         return ikcp_check(self.ckcp, current)
 
     cpdef int input(self, char *buffer, int length):
-        return ikcp_input(self.ckcp, buffer, length)
+        cdef int res
+        with nogil:
+            res = kcp_input(self.ckcp, &self.sock, buffer, length)
+        return res
 
     cpdef int wndsize(self, int sndwnd, int rcvwnd):
-        return ikcp_wndsize(self.ckcp, sndwnd, rcvwnd)
+        set_windows(self.ckcp, &self.sock, sndwnd, rcvwnd)
+        if self.sock.tuner != NULL:
+            self.sock.tuner.max_snd = self.sock.pacer.snd_wnd if self.sock.pacer != NULL else self.ckcp.snd_wnd
+            self.sock.tuner.max_rcv = self.ckcp.rcv_wnd
+        return 0
 
     cpdef int nodelay(self, int nodelay, int interval, int resend, int nc):
         return ikcp_nodelay(self.ckcp, nodelay, interval, resend, nc)
@@ -125,12 +1444,773 @@ cdef class KCP:
     cpdef int peeksize(self):
         return ikcp_peeksize(self.ckcp)
 
+    cpdef int waitsnd(self):
+        return ikcp_waitsnd(self.ckcp)
+
     cpdef int set_mtu(self, int mtu):
         return ikcp_setmtu(self.ckcp, mtu)
 
     cpdef void flush(self):
-        ikcp_flush(self.ckcp)
+        with nogil:
+            if self.sock.pacer != NULL:
+                pacer_release(&self.sock, self.ckcp, self.ckcp.current)
+            ikcp_flush(self.ckcp)
+            fec_flush(&self.sock, self.ckcp)
+            if loop_batch.count:
+                batch_send(&self.sock)
 
     def set_output(self, output):
         self.output = output
+        self.sock.fd = -1
+        self.ckcp.user = <void *> self
         ikcp_setoutput(self.ckcp, output_wrapper)
+
+    def stats(self):
+        """snapshot of the counters named in STATS_FIELDS"""
+        cdef int64_t row[STATS_SIZE]
+        fill_stats(self.ckcp, &self.sock, row)
+        return dict(zip(STATS_FIELDS, row))
+
+    def set_output_socket(self, int fd, tuple address=None, bint gso=False):
+        """
+        write output straight to the udp socket fd, the packets of every update/flush
+        go out with one sendmmsg(2). address is only needed for unconnected sockets.
+        with gso equally sized packets are handed to the kernel as one UDP_SEGMENT send.
+        packets the kernel refuses are dropped and counted in ``dropped``.
+        """
+        self.sock.address_len = to_sockaddr(address, &self.sock.address) if address is not None else 0
+        self.sock.fd = fd
+        self.sock.gso = gso
+        self.output = None
+        self.ckcp.user = &self.sock
+        ikcp_setoutput(self.ckcp, batch_output)
+
+    def set_pacing(self, bint enabled, double rate=0):
+        """
+        pace the data packets of socket output through a token bucket filled at 1.25
+        windows per smoothed rtt, at most rate bytes per second when rate is given.
+        acks and probes are never held back, not even those packed with data.
+        the send window stops growing while a window of packets is queued.
+        disabling drops the queued packets.
+        """
+        cdef Pacer *pacer = self.sock.pacer
+        if not enabled:
+            if pacer != NULL:
+                self.set_congestion('kcp')
+                self.ckcp.snd_wnd = pacer.snd_wnd
+                free(pacer.data)
+                free(pacer)
+                self.sock.pacer = NULL
+            return
+        if pacer == NULL:
+            pacer = <Pacer *> calloc(1, sizeof(Pacer))
+            if pacer == NULL:
+                raise MemoryError()
+            pacer.snd_wnd = self.ckcp.snd_wnd
+            self.sock.pacer = pacer
+        pacer.cap = rate / 1000
+
+    def set_autotune(self, bint enabled, int min_wnd=32):
+        """
+        tune both windows from the delivery rate and srtt while the session is
+        updated, between min_wnd and the windows set by wndsize, which they start
+        from min_wnd. ikcp keeps the receive window at 128 segments at least.
+        """
+        cdef Tuner *tuner = self.sock.tuner
+        if not enabled:
+            if tuner != NULL:
+                set_windows(self.ckcp, &self.sock, tuner.max_snd, tuner.max_rcv)
+                free(tuner)
+                self.sock.tuner = NULL
+            return
+        if tuner == NULL:
+            tuner = <Tuner *> calloc(1, sizeof(Tuner))
+            if tuner == NULL:
+                raise MemoryError()
+            tuner.max_snd = self.sock.pacer.snd_wnd if self.sock.pacer != NULL else self.ckcp.snd_wnd
+            tuner.max_rcv = self.ckcp.rcv_wnd
+            self.sock.tuner = tuner
+        tuner.min_wnd = max(min_wnd, 1)
+        tuner.last = kcp_now()
+        tuner.snd_una = self.ckcp.snd_una
+        tuner.rcv_nxt = self.ckcp.rcv_nxt
+        set_windows(self.ckcp, &self.sock, min(tuner.min_wnd, tuner.max_snd), min(tuner.min_wnd, tuner.max_rcv))
+
+    def set_fec(self, int data, int parity=3):
+        """
+        send every packet as a data shard followed, every `data` shards, by `parity`
+        Reed-Solomon parity shards, and rebuild lost packets from received shards.
+        the peer must use the same shards. shrinks the mtu by the shard header, call
+        it after set_mtu. data 0 turns it off.
+        """
+        cdef Fec *fec = self.sock.fec
+        cdef int i, j
+        if fec != NULL:
+            ikcp_setmtu(self.ckcp, self.ckcp.mtu + FEC_OVERHEAD)
+            free(fec.matrix)
+            free(fec.packet)
+            free(fec.parity_packets)
+            free(fec.shards)
+            free(fec.recovered)
+            free(fec)
+            self.sock.fec = NULL
+        if data == 0:
+            return
+        if data < 1 or parity < 1 or data + parity > FEC_MAX_SHARDS:
+            raise ValueError('fec needs 1 to {} shards, data and parity at least 1'.format(FEC_MAX_SHARDS))
+        if ikcp_setmtu(self.ckcp, self.ckcp.mtu - FEC_OVERHEAD) < 0:
+            raise ValueError('mtu too small for fec')
+        fec = <Fec *> calloc(1, sizeof(Fec))
+        if fec == NULL:
+            raise MemoryError()
+        self.sock.fec = fec
+        fec.data = data
+        fec.parity = parity
+        fec.conv = self.ckcp.conv
+        fec.stride = self.ckcp.mtu + 2
+        fec.matrix = <uint8_t *> malloc(parity * data)
+        fec.packet = <char *> malloc(FEC_OVERHEAD + self.ckcp.mtu)
+        fec.parity_packets = <char *> calloc(parity, FEC_HEADER + fec.stride)
+        fec.shards = <char *> malloc(FEC_GROUPS * (data + parity) * fec.stride)
+        fec.recovered = <char *> malloc(fec.stride)
+        if (fec.matrix == NULL or fec.packet == NULL or fec.parity_packets == NULL or fec.shards == NULL
+                or fec.recovered == NULL):
+            self.set_fec(0)
+            raise MemoryError()
+        for i in range(parity):
+            for j in range(data):
+                fec.matrix[i * data + j] = gf_inv(<uint8_t> ((data + i) ^ j))
+
+    def set_congestion(self, str name):
+        """
+        replace ikcp's congestion window with a controller of CONGESTION_CONTROLS,
+        'kcp' goes back to ikcp's own as set by nodelay. controllers work through the
+        pacer, which is enabled with them.
+        """
+        cdef const CongestionOps *ops
+        cdef Congestion *cc
+        if name != 'kcp' and name not in CONGESTION_CONTROLS:
+            raise ValueError('unknown congestion control {}'.format(name))
+        if self.sock.pacer != NULL and self.sock.pacer.cc != NULL:
+            cc = self.sock.pacer.cc
+            self.ckcp.nocwnd = cc.nocwnd
+            self.ckcp.snd_wnd = self.sock.pacer.snd_wnd
+            self.sock.pacer.cc = NULL
+            free(cc)
+        if name == 'kcp':
+            return
+        ops = <const CongestionOps *> PyCapsule_GetPointer(CONGESTION_CONTROLS[name], b'kcp.congestion')
+        if self.sock.pacer == NULL:
+            self.set_pacing(True)
+        cc = <Congestion *> calloc(1, sizeof(Congestion) + ops.size)
+        if cc == NULL:
+            raise MemoryError()
+        cc.ops = ops
+        cc.state = cc + 1
+        cc.nocwnd = self.ckcp.nocwnd
+        ops.init(cc)
+        self.ckcp.nocwnd = 1
+        self.sock.pacer.cc = cc
+
+
+DEF READABLE = 1
+DEF WRITABLE = 2
+DEF DEAD = 4
+
+ctypedef struct GroupEntry:
+    ikcpcb *ckcp
+    OutputSocket *sock
+    IUINT32 due
+    IUINT32 idle_since
+    IINT32 wait
+    int waitsnd_low
+    unsigned char events
+    bint active
+    bint idle
+    bint dirty
+    bint closing
+
+
+cdef inline void kcp_service(ikcpcb *ckcp, IUINT32 now, bint dirty) nogil:
+    """ikcp_update, or a flush right away for a dirty kcp that is not due yet"""
+    if dirty and ckcp.updated and <IINT32> (now - ckcp.ts_flush) < 0:
+        ckcp.current = now
+        ikcp_flush(ckcp)
+    else:
+        ikcp_update(ckcp, now)
+
+
+cdef void update_entries(GroupEntry *entries, Py_ssize_t start, Py_ssize_t end,
+                         IUINT32 now, Batch *batch) nogil:
+    """
+    update the due entries of a range. leaves READABLE, WRITABLE and DEAD in
+    their events and the ms until they are due in wait, -1 for idle entries.
+    dirty entries are flushed even when their interval has not elapsed.
+    """
+    cdef GroupEntry *entry
+    cdef IINT32 paced
+    cdef ikcpcb *ckcp
+    cdef OutputSocket *sock
+    cdef Py_ssize_t i
+    for i in range(start, end):
+        entry = &entries[i]
+        ckcp = entry.ckcp
+        entry.events = 0
+        if not entry.active:
+            if entry.idle:
+                entry.wait = -1
+                continue
+            entry.wait = <IINT32> (entry.due - now)
+            if entry.wait > 0:
+                continue
+        entry.active = False
+        sock = entry.sock
+        if sock.fd >= 0:
+            sock.batch = batch
+            if sock.pacer != NULL:
+                pacer_release(sock, ckcp, now)
+            kcp_service(ckcp, now, entry.dirty)
+            fec_flush(sock, ckcp)
+            if batch.count:
+                batch_send(sock)
+            sock.batch = &loop_batch
+        else:
+            kcp_service(ckcp, now, entry.dirty)
+            fec_flush(sock, ckcp)
+        if sock.tuner != NULL:
+            autotune(sock, ckcp, now)
+        entry.dirty = False
+        if <IINT32> ckcp.state == -1 or (entry.closing and ikcp_waitsnd(ckcp) == 0):
+            entry.events = DEAD
+            entry.wait = -1
+            continue
+        if entry.waitsnd_low >= 0 and ikcp_waitsnd(ckcp) <= entry.waitsnd_low:
+            entry.waitsnd_low = -1
+            entry.events |= WRITABLE
+        if ikcp_peeksize(ckcp) >= 0:
+            entry.events |= READABLE
+        paced = pacer_wait(sock.pacer, ckcp)
+        if kcp_idle(ckcp) and paced < 0:
+            if not entry.idle:
+                entry.idle = True
+                entry.idle_since = now
+            entry.wait = -1
+            continue
+        entry.idle = False
+        entry.due = ikcp_check(ckcp, now)
+        entry.wait = <IINT32> (entry.due - now)
+        if 0 <= paced < entry.wait:
+            entry.due = now + paced
+            entry.wait = paced
+        if entry.wait < 0:
+            entry.wait = 0
+
+
+# engine threads. update_groups splits the due work of all groups it is given
+# between the calling thread and the engine threads and waits for all of them,
+# so a KCP is never touched by two threads at once and the event loop can use
+# the sessions again as soon as update_groups returns.
+ctypedef void (*engine_job)(void *arg, int shard) nogil
+
+ctypedef struct Engine:
+    int shards
+    pthread_mutex_t lock
+    pthread_cond_t start
+    pthread_cond_t done
+    unsigned long generation
+    int running
+    engine_job job
+    void *arg
+    Batch *batches
+
+ctypedef struct GroupsJob:
+    GroupEntry **entries
+    Py_ssize_t *sizes
+    Py_ssize_t groups
+    Py_ssize_t total
+    IUINT32 now
+
+cdef Engine engine
+engine.shards = 1
+
+
+cdef void *engine_thread(void *arg) nogil:
+    cdef int shard = <int> <size_t> arg
+    cdef unsigned long seen = 0
+    cdef engine_job job
+    cdef void *job_arg
+    while True:
+        pthread_mutex_lock(&engine.lock)
+        while engine.generation == seen:
+            pthread_cond_wait(&engine.start, &engine.lock)
+        seen = engine.generation
+        job = engine.job
+        job_arg = engine.arg
+        pthread_mutex_unlock(&engine.lock)
+        job(job_arg, shard)
+        pthread_mutex_lock(&engine.lock)
+        engine.running -= 1
+        if engine.running == 0:
+            pthread_cond_signal(&engine.done)
+        pthread_mutex_unlock(&engine.lock)
+    return NULL
+
+
+cdef void engine_run(engine_job job, void *arg) nogil:
+    pthread_mutex_lock(&engine.lock)
+    engine.job = job
+    engine.arg = arg
+    engine.running = engine.shards - 1
+    engine.generation += 1
+    pthread_cond_broadcast(&engine.start)
+    pthread_mutex_unlock(&engine.lock)
+    job(arg, 0)
+    pthread_mutex_lock(&engine.lock)
+    while engine.running:
+        pthread_cond_wait(&engine.done, &engine.lock)
+    pthread_mutex_unlock(&engine.lock)
+
+
+cdef void update_shard(void *arg, int shard) nogil:
+    cdef GroupsJob *job = <GroupsJob *> arg
+    cdef Py_ssize_t first = job.total * shard // engine.shards
+    cdef Py_ssize_t last = job.total * (shard + 1) // engine.shards
+    cdef Py_ssize_t offset = 0
+    cdef Py_ssize_t g, start, end
+    cdef Batch *batch = &engine.batches[shard] if shard else &loop_batch
+    for g in range(job.groups):
+        start = max(first - offset, 0)
+        end = min(last - offset, job.sizes[g])
+        if start < end:
+            update_entries(job.entries[g], start, end, job.now, batch)
+        offset += job.sizes[g]
+        if offset >= last:
+            break
+
+
+def start_engine(int threads):
+    """
+    share the updates of update_groups between threads, the calling thread
+    included. can only be called once per process.
+    """
+    global threaded
+    cdef pthread_t thread
+    cdef int shard
+    if engine.shards != 1:
+        raise RuntimeError('engine already started')
+    if threads < 2:
+        return
+    engine.batches = <Batch *> PyMem_Malloc(threads * sizeof(Batch))
+    if engine.batches == NULL:
+        raise MemoryError()
+    memset(engine.batches, 0, threads * sizeof(Batch))
+    pthread_mutex_init(&engine.lock, NULL)
+    pthread_cond_init(&engine.start, NULL)
+    pthread_cond_init(&engine.done, NULL)
+    threaded = True
+    for shard in range(1, threads):
+        if pthread_create(&thread, NULL, engine_thread, <void *> <size_t> shard) != 0:
+            raise OSError(errno, strerror(errno).decode())
+        pthread_detach(thread)
+        engine.shards = shard + 1
+
+
+def update_groups(list groups, IUINT32 now):
+    """
+    update every due member of the groups without holding the GIL, on the engine
+    threads when there are enough members. returns KCPGroup.update's result for each group.
+    """
+    cdef Py_ssize_t count = len(groups)
+    cdef GroupsJob job
+    cdef KCPGroup group
+    cdef Py_ssize_t g
+    cdef list results = []
+    job.entries = <GroupEntry **> PyMem_Malloc(count * sizeof(GroupEntry *) + 1)
+    job.sizes = <Py_ssize_t *> PyMem_Malloc(count * sizeof(Py_ssize_t) + 1)
+    if job.entries == NULL or job.sizes == NULL:
+        PyMem_Free(job.entries)
+        PyMem_Free(job.sizes)
+        raise MemoryError()
+    job.groups = count
+    job.total = 0
+    job.now = now
+    for g in range(count):
+        group = <KCPGroup> groups[g]
+        job.entries[g] = group.entries
+        job.sizes[g] = group.size
+        job.total += group.size
+    with nogil:
+        if engine.shards > 1 and job.total >= PARALLEL_MIN:
+            engine_run(update_shard, &job)
+        else:
+            for g in range(count):
+                update_entries(job.entries[g], 0, job.sizes[g], now, &loop_batch)
+    PyMem_Free(job.entries)
+    PyMem_Free(job.sizes)
+    for g in range(count):
+        results.append((<KCPGroup> groups[g]).collect())
+    return results
+
+
+cdef class KCPGroup:
+    """
+    the KCPs of one tunnel, updated together in C. a member is due once it has
+    been activated or its ikcp_check deadline has passed. idle members are left
+    alone until they are activated again.
+    """
+    cdef GroupEntry *entries
+    cdef Py_ssize_t size, capacity
+    cdef dict index
+    cdef readonly dict kcps
+
+    def __cinit__(self):
+        self.entries = NULL
+        self.size = 0
+        self.capacity = 0
+        self.index = {}
+        self.kcps = {}
+
+    def __dealloc__(self):
+        PyMem_Free(self.entries)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, KCP kcp):
+        cdef IUINT32 conv = kcp.ckcp.conv
+        cdef GroupEntry *entries
+        cdef GroupEntry *entry
+        if conv in self.index:
+            raise ValueError('conv {} already in group'.format(conv))
+        if self.size == self.capacity:
+            entries = <GroupEntry *> PyMem_Realloc(self.entries, (self.capacity * 2 + 16) * sizeof(GroupEntry))
+            if entries == NULL:
+                raise MemoryError()
+            self.entries = entries
+            self.capacity = self.capacity * 2 + 16
+        entry = &self.entries[self.size]
+        entry.ckcp = kcp.ckcp
+        entry.sock = &kcp.sock
+        entry.due = 0
+        entry.idle_since = 0
+        entry.wait = -1
+        entry.waitsnd_low = -1
+        entry.events = 0
+        entry.active = True
+        entry.idle = False
+        entry.dirty = False
+        entry.closing = False
+        self.index[conv] = self.size
+        self.kcps[conv] = kcp
+        self.size += 1
+
+    def remove(self, IUINT32 conv):
+        cdef Py_ssize_t i = self.index.pop(conv)
+        del self.kcps[conv]
+        self.size -= 1
+        if i != self.size:
+            self.entries[i] = self.entries[self.size]
+            self.index[self.entries[i].ckcp.conv] = i
+
+    def clear(self):
+        self.size = 0
+        self.index.clear()
+        self.kcps.clear()
+
+    def activate(self, IUINT32 conv, bint flush=False):
+        """update conv on the next update, with flush it is flushed then even if it is not due"""
+        cdef GroupEntry *entry
+        i = self.index.get(conv)
+        if i is not None:
+            entry = &self.entries[<Py_ssize_t> i]
+            entry.active = True
+            entry.dirty |= flush
+
+    def close(self, IUINT32 conv):
+        """report conv as dead from update once everything it sent has been acknowledged"""
+        i = self.index.get(conv)
+        if i is not None:
+            self.entries[<Py_ssize_t> i].closing = True
+
+    def watch_waitsnd(self, IUINT32 conv, int low):
+        """report conv as writable from update once its waitsnd is at most low"""
+        i = self.index.get(conv)
+        if i is not None:
+            self.entries[<Py_ssize_t> i].waitsnd_low = low
+
+    def update(self, IUINT32 now):
+        """
+        update every due member. returns the convs with a message ready for recv,
+        the watched convs that became writable, the dead convs and the ms until
+        the earliest deadline, -1 when every member is idle.
+        """
+        return update_groups([self], now)[0]
+
+    cdef tuple collect(self):
+        cdef list readable = []
+        cdef list writable = []
+        cdef list dead = []
+        cdef IINT32 delay = -1
+        cdef GroupEntry *entry
+        cdef Py_ssize_t i
+        for i in range(self.size):
+            entry = &self.entries[i]
+            if entry.wait >= 0 and (delay < 0 or entry.wait < delay):
+                delay = entry.wait
+            if entry.events:
+                if entry.events & DEAD:
+                    dead.append(entry.ckcp.conv)
+                    continue
+                if entry.events & WRITABLE:
+                    writable.append(entry.ckcp.conv)
+                if entry.events & READABLE:
+                    readable.append(entry.ckcp.conv)
+        return readable, writable, dead, delay
+
+    def stats(self):
+        """
+        snapshot of every member as one array of int64, a row of
+        ``len(STATS_FIELDS)`` counters per member in STATS_FIELDS order.
+        """
+        cdef array.array rows = array.clone(stats_template, self.size * STATS_SIZE, zero=False)
+        cdef int64_t *data = <int64_t *> rows.data.as_voidptr
+        cdef Py_ssize_t i
+        for i in range(self.size):
+            fill_stats(self.entries[i].ckcp, self.entries[i].sock, data + i * STATS_SIZE)
+        return rows
+
+    def expired(self, IUINT32 now, IUINT32 timeout):
+        """convs idle for longer than timeout ms"""
+        cdef list convs = []
+        cdef GroupEntry *entry
+        cdef Py_ssize_t i
+        for i in range(self.size):
+            entry = &self.entries[i]
+            if entry.idle and not entry.active and <IINT32> (now - entry.idle_since) > <IINT32> timeout:
+                convs.append(entry.ckcp.conv)
+        return convs
+
+
+cdef bint input_packet(dict kcps, const char *packet, unsigned int length, set convs) except -1:
+    """input one packet into the KCP of its conv, returns False if the conv is unknown"""
+    cdef IUINT32 conv = ikcp_getconv(packet)
+    cdef object kcp = kcps.get(conv)
+    if kcp is None:
+        return False
+    if kcp_input((<KCP> kcp).ckcp, &(<KCP> kcp).sock, packet, length) == 0:
+        convs.add(conv)
+    return True
+
+
+cdef list readable_convs(dict kcps, set convs):
+    cdef list readable = []
+    cdef object conv
+    for conv in convs:
+        if ikcp_peeksize((<KCP> kcps[conv]).ckcp) >= 0:
+            readable.append(conv)
+    return readable
+
+
+def input_batch(list datagrams, dict kcps):
+    """
+    input every datagram into the KCP of its conv found in ``kcps``. returns the set
+    of convs that took input, the ones among them with a message ready for recv and
+    the indexes of datagrams with unknown conv.
+    """
+    cdef set convs = set()
+    cdef list rejected = []
+    cdef Py_ssize_t i
+    cdef bytes data
+    for i in range(len(datagrams)):
+        data = datagrams[i]
+        if len(data) < 24:
+            continue
+        if not input_packet(kcps, data, len(data), convs):
+            rejected.append(i)
+    return convs, readable_convs(kcps, convs), rejected
+
+
+cdef class Receiver:
+    """
+    drains a non blocking udp socket with recvmmsg(2) into preallocated buffers
+    and feeds the packets to their KCP in one call.
+
+    with gro the socket must have UDP_GRO enabled and size should fit a 64KiB
+    datagram. datagrams coalesced by the kernel are split back into their
+    packets, ``count``, ``packet`` and ``address`` refer to the split packets.
+    on a socket with SO_RXQ_OVFL enabled ``drops`` follows the kernel's count
+    of packets dropped because the receive buffer was full.
+    """
+    cdef int fd
+    cdef readonly unsigned int packets, size, count
+    cdef readonly bint gro
+    cdef readonly uint32_t drops
+    cdef char *data
+    cdef mmsghdr *msgs
+    cdef iovec *iov
+    cdef sockaddr_storage *addresses
+    cdef uint64_t *control
+    cdef unsigned int capacity
+    cdef char **starts
+    cdef unsigned int *lengths
+    cdef unsigned int *origins
+
+    def __cinit__(self, int fd, unsigned int packets=64, unsigned int size=2048, bint gro=False):
+        cdef unsigned int i
+        self.fd = fd
+        self.packets = packets
+        self.size = size
+        self.count = 0
+        self.gro = gro
+        self.drops = 0
+        self.capacity = packets * GSO_SEGMENTS if gro else packets
+        self.data = <char *> PyMem_Malloc(packets * size)
+        self.msgs = <mmsghdr *> PyMem_Malloc(packets * sizeof(mmsghdr))
+        self.iov = <iovec *> PyMem_Malloc(packets * sizeof(iovec))
+        self.addresses = <sockaddr_storage *> PyMem_Malloc(packets * sizeof(sockaddr_storage))
+        self.control = <uint64_t *> PyMem_Malloc(packets * CONTROL_WORDS * sizeof(uint64_t))
+        self.starts = <char **> PyMem_Malloc(self.capacity * sizeof(char *))
+        self.lengths = <unsigned int *> PyMem_Malloc(self.capacity * sizeof(unsigned int))
+        self.origins = <unsigned int *> PyMem_Malloc(self.capacity * sizeof(unsigned int))
+        if not (self.data and self.msgs and self.iov and self.addresses and self.control
+                and self.starts and self.lengths and self.origins):
+            raise MemoryError()
+        memset(self.msgs, 0, packets * sizeof(mmsghdr))
+        for i in range(packets):
+            self.iov[i].iov_base = self.data + i * size
+            self.iov[i].iov_len = size
+            self.msgs[i].msg_hdr.msg_iov = &self.iov[i]
+            self.msgs[i].msg_hdr.msg_iovlen = 1
+            self.msgs[i].msg_hdr.msg_name = &self.addresses[i]
+            self.msgs[i].msg_hdr.msg_control = &self.control[i * CONTROL_WORDS]
+
+    def __dealloc__(self):
+        PyMem_Free(self.data)
+        PyMem_Free(self.msgs)
+        PyMem_Free(self.iov)
+        PyMem_Free(self.addresses)
+        PyMem_Free(self.control)
+        PyMem_Free(self.starts)
+        PyMem_Free(self.lengths)
+        PyMem_Free(self.origins)
+
+    def recv(self):
+        """
+        receive up to ``packets`` datagrams without blocking, returns how many arrived.
+        truncated datagrams are skipped.
+        """
+        cdef unsigned int i
+        cdef int n
+        for i in range(self.packets):
+            self.msgs[i].msg_hdr.msg_namelen = sizeof(sockaddr_storage)
+            self.msgs[i].msg_hdr.msg_controllen = CONTROL_WORDS * sizeof(uint64_t)
+        with nogil:
+            n = recvmmsg(self.fd, self.msgs, self.packets, MSG_DONTWAIT, NULL)
+            if n > 0:
+                self.split(n)
+        if n < 0:
+            self.count = 0
+            if errno == EAGAIN:
+                return 0
+            raise OSError(errno, strerror(errno).decode())
+        return n
+
+    cdef void split(self, unsigned int received) nogil:
+        """
+        fill the packet table from the received datagrams, cutting gro datagrams at
+        their segment size, and pick up the kernel drop count.
+        """
+        cdef unsigned int i
+        cdef unsigned int count = 0
+        cdef unsigned int length, segment, offset
+        cdef msghdr *hdr
+        cdef cmsghdr *cmsg
+        for i in range(received):
+            hdr = &self.msgs[i].msg_hdr
+            if hdr.msg_flags & MSG_TRUNC:
+                continue
+            length = self.msgs[i].msg_len
+            segment = length
+            cmsg = CMSG_FIRSTHDR(hdr)
+            while cmsg != NULL:
+                if cmsg.cmsg_level == SOL_UDP and cmsg.cmsg_type == UDP_GRO and self.gro:
+                    segment = (<int *> CMSG_DATA(cmsg))[0]
+                elif cmsg.cmsg_level == SOL_SOCKET and cmsg.cmsg_type == SO_RXQ_OVFL:
+                    self.drops = (<uint32_t *> CMSG_DATA(cmsg))[0]
+                cmsg = CMSG_NXTHDR(hdr, cmsg)
+            if segment == 0:
+                segment = length
+            offset = 0
+            while offset < length and count < self.capacity:
+                self.starts[count] = self.data + i * self.size + offset
+                self.lengths[count] = min(segment, length - offset)
+                self.origins[count] = i
+                offset += self.lengths[count]
+                count += 1
+        self.count = count
+
+    def packet(self, unsigned int i):
+        if i >= self.count:
+            raise IndexError(i)
+        return PyBytes_FromStringAndSize(self.starts[i], self.lengths[i])
+
+    def address(self, unsigned int i):
+        if i >= self.count:
+            raise IndexError(i)
+        return from_sockaddr(&self.addresses[self.origins[i]])
+
+    def input(self, dict kcps):
+        """like input_batch for the received packets"""
+        cdef set convs = set()
+        cdef list rejected = []
+        cdef unsigned int i
+        cdef unsigned int length
+        for i in range(self.count):
+            length = self.lengths[i]
+            if length < 24:
+                continue
+            if not input_packet(kcps, self.starts[i], length, convs):
+                rejected.append(i)
+        return convs, readable_convs(kcps, convs), rejected
+
+    def demux(self, dict routes):
+        """
+        like input for a socket shared by many peers, ``routes`` maps an address to its
+        conv -> KCP dict. convs are returned as (address, conv) keys.
+        """
+        cdef set keys = set()
+        cdef list readable = []
+        cdef list rejected = []
+        cdef unsigned int i
+        cdef unsigned int length
+        cdef char *packet
+        cdef IUINT32 conv
+        cdef object address = None
+        cdef object kcps = None
+        cdef object kcp
+        cdef sockaddr_storage *last = NULL
+        cdef socklen_t last_len = 0
+        cdef unsigned int origin
+        for i in range(self.count):
+            length = self.lengths[i]
+            if length < 24:
+                continue
+            packet = self.starts[i]
+            conv = ikcp_getconv(packet)
+            origin = self.origins[i]
+            # bursts come from the same peer, only decode an address that changed
+            if (last == NULL or self.msgs[origin].msg_hdr.msg_namelen != last_len
+                    or memcmp(&self.addresses[origin], last, last_len) != 0):
+                last = &self.addresses[origin]
+                last_len = self.msgs[origin].msg_hdr.msg_namelen
+                address = from_sockaddr(last)
+                kcps = routes.get(address)
+            kcp = None if kcps is None else (<dict> kcps).get(conv)
+            if kcp is None:
+                rejected.append(i)
+            elif kcp_input((<KCP> kcp).ckcp, &(<KCP> kcp).sock, packet, length) == 0:
+                keys.add((address, conv))
+        for address, conv in keys:
+            if ikcp_peeksize((<KCP> routes[address][conv]).ckcp) >= 0:
+                readable.append((address, conv))
+        return keys, readable, rejected
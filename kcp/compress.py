@@ -0,0 +1,196 @@
+import asyncio
+import math
+import zlib
+from collections import Counter, deque
+
+RAW = 0
+DEFLATE = 1
+HEADER_BYTES = 4
+FRAME_BYTES = 1 << 20
+MIN_BYTES = 128
+SAMPLE_BYTES = 1024
+ENTROPY_LIMIT = 7.5
+THREAD_BYTES = 64 * 1024
+POOR_RATIO = 0.9
+MAX_BACKOFF = 64
+
+
+def entropy(sample):
+    """shannon entropy of sample in bits per byte"""
+    size = len(sample)
+    return -sum(count / size * math.log2(count / size) for count in Counter(sample).values())
+
+
+def frame(kind, payload):
+    return bytes((kind,)) + len(payload).to_bytes(3, 'big') + payload
+
+
+class Deflater:
+    """
+    frames the writes of one stream for ``Inflater``, deflating them with one zlib
+    stream so later writes refer back to earlier ones.
+
+    writes whose sample looks random are sent raw, and so are the next writes
+    after one that deflated poorly, for a backoff doubling up to MAX_BACKOFF.
+    writes of THREAD_BYTES and more are deflated in the loop's executor, the
+    ones after them wait in order and ``on_busy`` is told while one runs.
+    if that fails the queued writes are dropped, ``on_error`` is told and
+    later writes are ignored.
+    """
+
+    def __init__(self, send, level, on_busy, on_error):
+        self.send = send
+        self.on_busy = on_busy
+        self.on_error = on_error
+        self.error = None
+        self.deflater = zlib.compressobj(level)
+        self.queue = deque()
+        self.running = False
+        self.skip = 0
+        self.backoff = 1
+
+    @property
+    def busy(self):
+        return self.running or bool(self.queue)
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        for start in range(0, len(data), FRAME_BYTES):
+            self.queue.append(bytes(data[start:start + FRAME_BYTES]))
+        if not self.running:
+            self.drain()
+
+    def drain(self):
+        queue = self.queue
+        while queue and not self.running:
+            data = queue.popleft()
+            if not self.should_deflate(data):
+                self.send(frame(RAW, data))
+            elif len(data) >= THREAD_BYTES:
+                self.running = True
+                self.on_busy(True)
+                future = asyncio.get_event_loop().run_in_executor(None, self.deflate, data)
+                future.add_done_callback(self.deflated)
+            else:
+                self.send(self.deflate(data))
+
+    def deflated(self, future):
+        self.running = False
+        self.error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        if self.error is not None:
+            self.queue.clear()
+            self.on_error(self.error)
+            return
+        self.send(future.result())
+        self.drain()
+        if not self.busy:
+            self.on_busy(False)
+
+    def should_deflate(self, data):
+        if len(data) < MIN_BYTES:
+            return False
+        if self.skip:
+            self.skip -= 1
+            return False
+        return entropy(data[:SAMPLE_BYTES]) < ENTROPY_LIMIT
+
+    def deflate(self, data):
+        deflater = self.deflater
+        payload = deflater.compress(data) + deflater.flush(zlib.Z_SYNC_FLUSH)
+        if len(payload) > POOR_RATIO * len(data):
+            self.skip = self.backoff
+            self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        else:
+            self.backoff = 1
+        return frame(DEFLATE, payload)
+
+
+class Inflater:
+    """
+    protocol wrapper turning the frames of a ``Deflater`` back into the stream.
+
+    a frame inflating to more than FRAME_BYTES is an error. frames of THREAD_BYTES
+    and more are inflated in the loop's executor, ``on_busy`` is told while one
+    runs so nothing more is received until it is done. on an error the rest of
+    the stream is dropped and ``on_error`` is told.
+    """
+
+    def __init__(self, protocol, on_busy, on_error):
+        self.protocol = protocol
+        self.on_busy = on_busy
+        self.on_error = on_error
+        self.inflater = zlib.decompressobj()
+        self.buffer = bytearray()
+        self.running = False
+        self.stopped = False
+
+    def __getattr__(self, item):
+        return getattr(self.protocol, item)
+
+    def data_received(self, data):
+        if self.stopped:
+            return
+        self.buffer += data
+        if not self.running:
+            self.drain()
+
+    def drain(self):
+        buffer = self.buffer
+        chunks = []
+        offset = 0
+        try:
+            while len(buffer) - offset >= HEADER_BYTES:
+                end = offset + HEADER_BYTES + int.from_bytes(buffer[offset + 1:offset + HEADER_BYTES], 'big')
+                if len(buffer) < end:
+                    break
+                kind = buffer[offset]
+                payload = bytes(buffer[offset + HEADER_BYTES:end])
+                offset = end
+                if kind != DEFLATE:
+                    chunks.append(payload)
+                elif len(payload) >= THREAD_BYTES:
+                    self.running = True
+                    future = asyncio.get_event_loop().run_in_executor(None, self.inflate, payload)
+                    future.add_done_callback(self.inflated)
+                    break
+                else:
+                    chunks.append(self.inflate(payload))
+        except zlib.error as exc:
+            self.fail(exc)
+            return
+        del buffer[:offset]
+        data = b''.join(chunks)
+        if data:
+            self.protocol.data_received(data)
+        if self.running:
+            self.on_busy(True)
+
+    def inflated(self, future):
+        self.running = False
+        if self.stopped:
+            return
+        error = asyncio.CancelledError() if future.cancelled() else future.exception()
+        if error is not None:
+            self.fail(error)
+            return
+        self.protocol.data_received(future.result())
+        self.drain()
+        if not self.running:
+            self.on_busy(False)
+
+    def inflate(self, payload):
+        inflater = self.inflater
+        data = inflater.decompress(payload, FRAME_BYTES + 1)
+        if len(data) > FRAME_BYTES or inflater.unconsumed_tail:
+            raise zlib.error(f'frame inflates to more than {FRAME_BYTES} bytes')
+        return data
+
+    def fail(self, exc):
+        self.stopped = True
+        self.buffer.clear()
+        self.on_error(exc)
+
+    def connection_lost(self, exc):
+        self.stopped = True
+        self.protocol.connection_lost(exc)
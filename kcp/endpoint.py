@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import socket
+from asyncio import transports
+
+from kcp.KCP import Receiver
+from kcp.utils import KCPConfig
+
+UDP_SEGMENT = 103
+UDP_GRO = 104
+SO_RXQ_OVFL = 40
+MAX_DATAGRAM = 65535
+DROPS_LOG_INTERVAL = 5
+
+
+class DatagramEngineTransport(transports.DatagramTransport):
+    """
+    datagram transport reading its socket with recvmmsg(2).
+
+    protocols providing ``datagrams_received(receiver)`` get every batch at once,
+    other protocols get ``datagram_received`` per packet like the stock transport.
+    the ``gso`` extra info tells whether the socket takes UDP_SEGMENT sends.
+    packets the kernel dropped for a full receive buffer are counted by ``get_drops``
+    and logged, at most every DROPS_LOG_INTERVAL seconds.
+    """
+
+    def __init__(self, loop, sock, protocol, address=None, packets=64, size=2048, waiter=None,
+                 gro=False, gso=False):
+        super().__init__()
+        self._loop = loop
+        self._sock = sock
+        self._protocol = protocol
+        self._address = address
+        self._receiver = Receiver(sock.fileno(), packets, MAX_DATAGRAM if gro else size, gro)
+        self._extra['socket'] = sock
+        self._extra['gso'] = gso
+        self._extra['sockname'] = sock.getsockname()
+        if address:
+            self._extra['peername'] = address
+        self._closing = False
+        self._drops = 0
+        self._drops_logged = 0
+        loop.call_soon(protocol.connection_made, self)
+        loop.call_soon(loop.add_reader, sock.fileno(), self._read_ready)
+        if waiter is not None:
+            loop.call_soon(self._wakeup_waiter, waiter)
+
+    @staticmethod
+    def _wakeup_waiter(waiter):
+        if not waiter.cancelled():
+            waiter.set_result(None)
+
+    def _read_ready(self):
+        receiver = self._receiver
+        protocol = self._protocol
+        batch_received = getattr(protocol, 'datagrams_received', None)
+        count = receiver.packets
+        while count == receiver.packets and not self._closing:
+            try:
+                count = receiver.recv()
+            except OSError as exc:
+                protocol.error_received(exc)
+                return
+            if batch_received is not None:
+                batch_received(receiver)
+            else:
+                for i in range(receiver.count):
+                    protocol.datagram_received(receiver.packet(i), receiver.address(i))
+        if receiver.drops != self._drops and self._loop.time() >= self._drops_logged + DROPS_LOG_INTERVAL:
+            logging.warning("kernel dropped %s packets, udp receive buffer full",
+                            (receiver.drops - self._drops) & 0xffffffff)
+            self._drops = receiver.drops
+            self._drops_logged = self._loop.time()
+
+    def get_drops(self):
+        """packets the kernel dropped because the socket receive buffer was full"""
+        return self._receiver.drops
+
+    def sendto(self, data, addr=None):
+        if self._closing:
+            return
+        try:
+            if self._address:
+                self._sock.send(data)
+            else:
+                self._sock.sendto(data, addr)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as exc:
+            self._protocol.error_received(exc)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.remove_reader(self._sock.fileno())
+        self._loop.call_soon(self._call_connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+    def _call_connection_lost(self, exc):
+        try:
+            self._protocol.connection_lost(exc)
+        finally:
+            self._sock.close()
+            self._sock = None
+            self._protocol = None
+
+
+def set_buffers(sock, rcvbuf, sndbuf):
+    """grow the socket buffers to at least rcvbuf and sndbuf bytes, warn when the kernel caps them"""
+    for option, size, limit in ((socket.SO_RCVBUF, rcvbuf, 'rmem_max'), (socket.SO_SNDBUF, sndbuf, 'wmem_max')):
+        if sock.getsockopt(socket.SOL_SOCKET, option) >= size:
+            continue
+        sock.setsockopt(socket.SOL_SOCKET, option, size)
+        # linux reports twice the requested size, room for its bookkeeping
+        actual = sock.getsockopt(socket.SOL_SOCKET, option)
+        if actual < size:
+            logging.warning("socket buffer capped at %s bytes, raise net.core.%s to %s", actual, limit, size)
+
+
+def buffer_sizes(config):
+    """socket buffer sizes holding a full receive and send window of mtu sized packets"""
+    return config.rcvwnd * config.mtu, config.sndwnd * config.mtu
+
+
+def enable_offload(sock):
+    """turn on UDP_GRO and probe UDP_SEGMENT, returns whether each is supported"""
+    supported = []
+    for option, value in ((UDP_GRO, 1), (UDP_SEGMENT, 0)):
+        try:
+            sock.setsockopt(socket.IPPROTO_UDP, option, value)
+            supported.append(True)
+        except OSError as exc:
+            logging.warning("udp offload option %s not supported: %s", option, exc)
+            supported.append(False)
+    return tuple(supported)
+
+
+async def create_datagram_endpoint(protocol_factory, local_addr=None, remote_addr=None,
+                                   reuse_address=None, reuse_port=None, packets=64, size=2048,
+                                   offload=False, rcvbuf=0, sndbuf=0):
+    """
+    same as loop.create_datagram_endpoint but with a recvmmsg based transport.
+    with offload the socket receives with UDP_GRO and is marked for UDP_SEGMENT sends.
+    the socket buffers are grown to rcvbuf and sndbuf and kernel drops are reported
+    with SO_RXQ_OVFL.
+    """
+    loop = asyncio.get_event_loop()
+    host, port = (remote_addr or local_addr)[:2]
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_DGRAM)
+    family, _, proto, _, address = infos[0]
+    sock = socket.socket(family, socket.SOCK_DGRAM, proto)
+    try:
+        sock.setblocking(False)
+        set_buffers(sock, rcvbuf, sndbuf)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+        except OSError as exc:
+            logging.warning("kernel drop counter not supported: %s", exc)
+        if reuse_address:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if local_addr:
+            if remote_addr:
+                infos = await loop.getaddrinfo(*local_addr[:2], family=family, type=socket.SOCK_DGRAM)
+                sock.bind(infos[0][4])
+            else:
+                sock.bind(address)
+        if remote_addr:
+            sock.connect(address)
+        gro, gso = enable_offload(sock) if offload else (False, False)
+    except OSError:
+        sock.close()
+        raise
+    protocol = protocol_factory()
+    waiter = loop.create_future()
+    transport = DatagramEngineTransport(loop, sock, protocol, address if remote_addr else None, packets, size, waiter,
+                                        gro, gso)
+    try:
+        await waiter
+    except BaseException:
+        transport.close()
+        raise
+    return transport, protocol
+
+
+async def create_endpoint(protocol_factory, **kwargs):
+    """
+    create the tunnel's udp endpoint with the transport selected by the config,
+    its socket buffers sized for the configured windows.
+    """
+    config = KCPConfig()
+    rcvbuf, sndbuf = buffer_sizes(config)
+    if config.recvmmsg:
+        return await create_datagram_endpoint(protocol_factory, size=max(2048, config.mtu), offload=config.offload,
+                                              rcvbuf=rcvbuf, sndbuf=sndbuf, **kwargs)
+    transport, protocol = await asyncio.get_event_loop().create_datagram_endpoint(protocol_factory, **kwargs)
+    set_buffers(transport.get_extra_info('socket'), rcvbuf, sndbuf)
+    return transport, protocol
@@ -1,7 +1,7 @@
 from setuptools import setup, Extension
 from Cython.Build import cythonize
 
-ext = Extension("KCP", sources=["kcp/KCP.pyx", "ikcp/ikcp.c"])
+ext = Extension("KCP", sources=["kcp/KCP.pyx", "ikcp/ikcp.c"], define_macros=[("IKCP_FASTACK_CONSERVE", None)])
 
 core = cythonize(ext)
 
@@ -8,35 +8,36 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 
 from kcp import utils
+from kcp.endpoint import create_endpoint
 from kcp.pipe import open_pipe
 from kcp.protocols import DataGramConnHandlerProtocol
 from kcp.updater import updater
+from kcp.workers import run_workers
 
 
 class LocalServerError(Exception):
     """local server error"""
 
 
-async def local_main():
+async def local_main(config):
     loop = asyncio.get_event_loop()
-    utils.check_python()
-    config = utils.get_config(True)
-    _, protocol = await loop.create_datagram_endpoint(
+    _, protocol = await create_endpoint(
         lambda: DataGramConnHandlerProtocol(is_local=True),
         remote_addr=(config.server, config.server_port)
     )
 
-    server = await asyncio.start_server(
-        functools.partial(open_pipe, ds_factory=protocol.create_connection),
+    server = await loop.create_server(
+        functools.partial(open_pipe, protocol.open_session),
         host=config.local,
-        port=config.local_port)
+        port=config.local_port,
+        reuse_port=config.workers > 1)
 
     logging.info("starting local at %s:%s", config.local, config.local_port)
     updater.load_config(config)
     updater.run()
     for signame in {'SIGQUIT', 'SIGTERM'}:
         loop.add_signal_handler(
-            getattr(signal, signame), lambda: asyncio.ensure_future(utils.shutdown(signame, loop)))
+            getattr(signal, signame), lambda signame=signame: asyncio.ensure_future(utils.shutdown(signame, loop)))
     try:
         async with server:
             await server.serve_forever()
@@ -47,7 +48,12 @@ async def local_main():
 
 
 def main():
-    asyncio.run(local_main())
+    utils.check_python()
+    config = utils.get_config(True)
+    if config.workers > 1:
+        run_workers(lambda: asyncio.run(local_main(config)), config.workers)
+    else:
+        asyncio.run(local_main(config))
 
 
 if __name__ == '__main__':
@@ -1,48 +1,126 @@
 import asyncio
 import logging
-from asyncio import StreamReader, StreamWriter
-from typing import Tuple
+from asyncio import protocols
 
+PIPE_TIMEOUT = 300
+SWEEP_INTERVAL = 5
 
-class DataPipeError(Exception):
-    """DataPipe Error"""
 
+class PipeEnd(protocols.Protocol):
+    """one end of a pipe, everything it receives is written to the other end's transport"""
 
-async def open_pipe(us_reader: StreamReader, us_writer: StreamWriter, ds_factory=None):
-    logging.info("pipe open")
-    ds_reader, ds_writer = await ds_factory()
-    pipe = DataPipe((us_reader, us_writer), (ds_reader, ds_writer))
-    try:
-        await pipe.flow(65536, 300)
-    finally:
-        logging.info("pipe closed")
-        us_writer.is_closing() or us_writer.close()
-        ds_writer.is_closing() or ds_writer.close()
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.peer = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.pipe.connected(self)
+
+    def data_received(self, data):
+        pipe = self.pipe
+        pipe.last_active = pipe.loop.time()
+        self.peer.transport.write(bytes(data))
+
+    def eof_received(self):
+        self.pipe.close()
+
+    def connection_lost(self, exc):
+        self.pipe.close()
 
+    def pause_writing(self):
+        self.peer.transport.pause_reading()
 
-class DataPipe:
+    def resume_writing(self):
+        self.peer.transport.resume_reading()
 
-    def __init__(self, upstream: Tuple[StreamReader, StreamWriter], downstream: Tuple[StreamReader, StreamWriter]):
-        self.upstream = upstream
-        self.downstream = downstream
 
-    async def flow(self, size, timeout):
-        us_reader, us_writer = self.upstream
-        ds_reader, ds_writer = self.downstream
+class Pipe:
+    """
+    joins an accepted connection to one opened by ``connect(protocol)``.
 
-        async def flowing(reader, writer):
+    data is forwarded from protocol callbacks straight to the other transport,
+    and an end whose write buffer is full pauses reading on the other end.
+    either end closing closes both. a kcp transport sends what it has queued
+    before its session ends, kcp has no FIN so the far pipe is left to time out.
+    """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.loop = asyncio.get_event_loop()
+        self.last_active = self.loop.time()
+        self.closing = False
+        self.upstream = PipeEnd(self)
+        self.downstream = PipeEnd(self)
+        self.upstream.peer = self.downstream
+        self.downstream.peer = self.upstream
+
+    def connected(self, end):
+        if self.closing:
+            end.transport.close()
+        elif end.peer.transport is not None:
+            end.peer.transport.resume_reading()
+        else:
+            logging.info("pipe open")
+            # nothing is read until the other end is connected
+            end.transport.pause_reading()
+            sweeper.add(self)
             try:
-                while not reader.at_eof() and not writer.is_closing():
-                    writer.write(await asyncio.wait_for(reader.read(size), timeout))
-            except asyncio.TimeoutError:
-                logging.info("timeout while reading data")
-            except DataPipeError:
-                logging.exception("pipe error")
-
-        tasks = {flowing(us_reader, ds_writer), flowing(ds_reader, us_writer)}
-        waiting = asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-        try:
-            done, tasks = await waiting
-        finally:
-            for task in tasks:
-                task.cancel()
+                res = self.connect(end.peer)
+            except Exception as exc:
+                logging.warning("pipe connect failed: %s", exc)
+                self.close()
+                return
+            if asyncio.iscoroutine(res):
+                self.loop.create_task(res).add_done_callback(self.connect_done)
+
+    def connect_done(self, future):
+        if future.cancelled():
+            self.close()
+        elif future.exception() is not None:
+            logging.warning("pipe connect failed: %s", future.exception())
+            self.close()
+
+    def close(self):
+        if self.closing:
+            return
+        self.closing = True
+        sweeper.discard(self)
+        for end in (self.upstream, self.downstream):
+            if end.transport is not None:
+                end.transport.close()
+        logging.info("pipe closed")
+
+
+class Sweeper:
+    """closes pipes idle for longer than PIPE_TIMEOUT with one timer shared by all of them"""
+
+    def __init__(self):
+        self.pipes = set()
+        self.handle = None
+
+    def add(self, pipe):
+        self.pipes.add(pipe)
+        if self.handle is None:
+            self.handle = pipe.loop.call_later(SWEEP_INTERVAL, self.sweep)
+
+    def discard(self, pipe):
+        self.pipes.discard(pipe)
+
+    def sweep(self):
+        loop = asyncio.get_event_loop()
+        time = loop.time()
+        idle = [pipe for pipe in self.pipes if time - pipe.last_active > PIPE_TIMEOUT]
+        for pipe in idle:
+            logging.info("pipe idle for %ss, closing", PIPE_TIMEOUT)
+            pipe.close()
+        self.handle = loop.call_later(SWEEP_INTERVAL, self.sweep) if self.pipes else None
+
+
+sweeper = Sweeper()
+
+
+def open_pipe(connect):
+    """protocol factory for the accepting side of a pipe"""
+    return Pipe(connect).upstream
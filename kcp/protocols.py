@@ -1,39 +1,153 @@
 import asyncio
+import functools
 import logging
-from asyncio import streams, transports, protocols
-from collections import defaultdict
+from asyncio import transports, protocols
 from dataclasses import dataclass
 
-from kcp.KCP import KCP, get_conv
+from kcp.KCP import KCP, KCPGroup, get_conv, input_batch, kcp_now
+from kcp.compress import Deflater, Inflater
 from kcp.updater import updater
 from kcp.utils import KCPConfig
 
+REAP_INTERVAL = 5
+IKCP_CMD_PUSH = 81
+FEC_OVERHEAD = 12
+FEC_DATA = b'\xf1\0'
 
-def new_kcp(conv, output):
+
+def is_handshake(data, fec=False):
+    """whether data starts with the first segment of a new kcp stream, in a data shard with fec"""
+    if fec:
+        if len(data) < FEC_OVERHEAD or data[8:10] != FEC_DATA:
+            return False
+        data = data[FEC_OVERHEAD:]
+    return len(data) >= 24 and data[4] == IKCP_CMD_PUSH and data[12:16] == b'\0\0\0\0'
+
+
+def new_kcp(conv, transport, address=None):
     config = KCPConfig()
     kcp = KCP(conv)
-    kcp.set_output(output)
+    if config.batch:
+        kcp.set_output_socket(transport.get_extra_info('socket').fileno(), address,
+                              transport.get_extra_info('gso', False))
+    elif address:
+        kcp.set_output(functools.partial(transport.sendto, addr=address))
+    else:
+        kcp.set_output(transport.sendto)
     kcp.set_mtu(config.mtu)
+    if config.fec_data:
+        kcp.set_fec(config.fec_data, config.fec_parity)
     kcp.nodelay(config.nodelay, config.interval, config.resend, config.nc)
     kcp.wndsize(config.sndwnd, config.rcvwnd)
+    if config.autotune:
+        kcp.set_autotune(True, config.autotune_min)
+    kcp.stream = config.stream
+    if config.batch:
+        if config.pacing or config.congestion != 'kcp':
+            kcp.set_pacing(True, config.pacing_rate * 1024)
+        if config.congestion != 'kcp':
+            kcp.set_congestion(config.congestion)
     return kcp
 
 
 class TunnelTransportWrapper(transports.Transport):
-
-    def __init__(self, transport, conn, kcp):
+    """
+    stream transport over a kcp session. the write buffer is the kcp send queue,
+    its size and limits are counted in segments (``kcp.waitsnd()``).
+
+    with ``--coalesce`` writes smaller than a segment are held back and queued
+    together on the next updater tick, or as soon as they fill a segment.
+    with ``--compress`` writes go through a ``Deflater`` first, the protocol is
+    paused while it deflates a large write off the loop and closing waits for it.
+    incoming frames go through an ``Inflater``, reading stays paused while it
+    inflates a large frame off the loop. a failed deflate or inflate aborts the session.
+    """
+
+    def __init__(self, transport, conn, kcp, protocol):
         self._transport = transport
         self._conn = conn
         self._kcp = kcp
+        self._protocol = protocol
+        self._protocol_paused = False
+        self._reading_paused = False
+        self._inflate_paused = False
         self._is_closing = False
+        self._coalesce = KCPConfig().coalesce
+        self._buffer = bytearray()
+        level = KCPConfig().compress
+        self._deflater = Deflater(self._write, level, self._deflating, self._compress_failed) if level else None
+        if level:
+            self._protocol = Inflater(protocol, self._inflating, self._compress_failed)
+        self.set_write_buffer_limits()
 
     def __getattr__(self, item):
         return getattr(self._transport, item)
 
+    def get_protocol(self):
+        return self._protocol
+
+    @property
+    def protocol_paused(self):
+        return self._protocol_paused
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = 2 * KCPConfig().sndwnd if low is None else 2 * low
+        if low is None:
+            low = high // 2
+        if not high >= low >= 0:
+            raise ValueError(f'high ({high!r}) must be >= low ({low!r}) must be >= 0')
+        self._high_water = high
+        self._low_water = low
+
+    def get_write_buffer_limits(self):
+        return self._low_water, self._high_water
+
+    def get_write_buffer_size(self):
+        return self._kcp.waitsnd()
+
+    def maybe_resume_protocol(self):
+        if self._protocol_paused and self._kcp.waitsnd() <= self._low_water:
+            self._protocol_paused = False
+            self._protocol.resume_writing()
+
     def write(self, data):
+        if not data:
+            return
+        if self._deflater is not None:
+            self._deflater.write(data)
+        else:
+            self._write(data)
+
+    def _write(self, data):
+        buffer = self._buffer
+        if self._coalesce and len(buffer) + len(data) < self._kcp.mss:
+            if not buffer:
+                updater.defer(self)
+            buffer += data
+            return
+        if buffer:
+            buffer += data
+            self._send(buffer)
+            buffer.clear()
+        else:
+            self._send(data)
+
+    def write_pending(self):
+        """queue the coalesced writes, called by the updater"""
+        buffer = self._buffer
+        if buffer:
+            self._send(buffer)
+            buffer.clear()
+
+    def _send(self, data):
         kcp = self._kcp
-        self._conn.active_sessions.add(kcp.conv)
-        kcp.send(data, len(data))
+        kcp.send_all(data)
+        updater.activate(self._conn, kcp.conv)
+        if not self._protocol_paused and kcp.waitsnd() > self._high_water:
+            self._protocol_paused = True
+            self._conn.group.watch_waitsnd(kcp.conv, self._low_water)
+            self._protocol.pause_writing()
 
     def writelines(self, list_of_data):
         data = b''.join(list_of_data)
@@ -46,17 +160,53 @@ class TunnelTransportWrapper(transports.Transport):
         return False
 
     def is_reading(self):
-        return True
+        return not (self._reading_paused or self._inflate_paused or self._is_closing)
 
     def pause_reading(self):
-        pass
+        # messages stay in rcv_queue, so kcp advertises a shrinking window to the peer
+        self._reading_paused = True
 
     def resume_reading(self):
-        pass
+        if self._reading_paused:
+            self._reading_paused = False
+            updater.activate(self._conn, self._kcp.conv, True)
+
+    def _deflating(self, busy):
+        if busy:
+            if not self._protocol_paused:
+                self._protocol_paused = True
+                self._protocol.pause_writing()
+            return
+        if self._kcp.waitsnd() > self._low_water:
+            self._conn.group.watch_waitsnd(self._kcp.conv, self._low_water)
+        else:
+            self.maybe_resume_protocol()
+        if self._is_closing:
+            self.close()
+
+    def _inflating(self, busy):
+        self._inflate_paused = busy
+        if not busy:
+            updater.activate(self._conn, self._kcp.conv, True)
 
     def close(self):
         self._is_closing = True
+        if self._deflater is not None and self._deflater.busy:
+            return
+        self.write_pending()
+        # the session ends once its send queue is acknowledged
+        self._conn.group.close(self._kcp.conv)
+        updater.activate(self._conn, self._kcp.conv, True)
+
+    def abort(self):
+        self._is_closing = True
+        self._buffer.clear()
         self._kcp.state = -1
+        updater.activate(self._conn, self._kcp.conv)
+
+    def _compress_failed(self, exc):
+        logging.warning("session %s compression failed: %r", self._kcp.conv, exc)
+        self.abort()
 
     def is_closing(self):
         return self._is_closing
@@ -64,141 +214,200 @@ class TunnelTransportWrapper(transports.Transport):
 
 @dataclass
 class Session:
-    protocol: streams.StreamReaderProtocol
+    protocol: protocols.Protocol
     transport: transports.Transport
     conv: int
     kcp: 'KCP'
-    next_update: int
 
 
 class DataGramConnHandlerProtocol(protocols.DatagramProtocol):
 
-    def __init__(self, is_local, client_connected_cb=None):
+    def __init__(self, is_local, protocol_factory=None, address=None):
         self.is_local = is_local
-        self.client_connected_cb = client_connected_cb
+        self.protocol_factory = protocol_factory
+        self.address = address
         self.conv = 1
         self.sessions = dict()
-        self.active_sessions = set()
-        self.accept_dict = defaultdict(bytearray)
+        self.group = KCPGroup()
+        self.kcps = self.group.kcps
+        self.next_update = None
+        self.pending = []
         self.transport = None
+        self.reaper = None
 
     def connection_made(self, transport):
         self.transport = transport
-        updater.register(self)
-
-    async def accept_connection(self, conv):
-        reader, writer = await self.create_connection(conv)
-        s = self.sessions[conv]
-        accept_dict = self.accept_dict
-        buffer = accept_dict[conv]
-        s.kcp.input(buffer, len(buffer))
-        res = self.client_connected_cb(reader, writer)
-        loop = asyncio.get_event_loop()
-        if asyncio.iscoroutine(res):
-            loop.create_task(res)
-        del accept_dict[conv]
-        self.active_sessions.add(conv)
+        if self.address is None:
+            self.reaper = asyncio.get_event_loop().call_later(REAP_INTERVAL, self.reaping)
 
-    async def create_connection(self, conv=None):
-        loop = asyncio.get_event_loop()
+    def accept_connection(self, conv, data):
+        self.new_session(conv, self.protocol_factory())
+        self.sessions[conv].kcp.input(data, len(data))
+        self.kcp_received(conv)
+
+    def open_session(self, protocol, conv=None):
+        """start a kcp session driving protocol, convs are allocated by the local side"""
         if self.is_local:
             conv = self.conv
             self.conv += 1
         else:
             assert conv
-            conv = conv
-        kcp = new_kcp(conv, self.transport.sendto)
-        reader = asyncio.StreamReader(loop=loop)
-        protocol = streams.StreamReaderProtocol(reader, loop=loop)
-        transport = TunnelTransportWrapper(self.transport, self, kcp)
-        writer = streams.StreamWriter(transport, protocol, reader, loop)
-        session = Session(protocol=protocol, transport=transport, kcp=kcp, conv=conv, next_update=0)
-        self.active_sessions.add(conv)
+        return self.new_session(conv, protocol)
+
+    def new_session(self, conv, protocol):
+        kcp = new_kcp(conv, self.transport, self.address)
+        transport = TunnelTransportWrapper(self.transport, self, kcp, protocol)
+        protocol = transport.get_protocol()
+        session = Session(protocol=protocol, transport=transport, kcp=kcp, conv=conv)
         self.sessions[conv] = session
-        return reader, writer
+        self.group.add(kcp)
+        protocol.connection_made(transport)
+        updater.activate(self, conv)
+        return transport
 
     def datagram_received(self, data: bytes, addr):
+        # packets of one loop iteration are input together by input_pending
+        pending = self.pending
+        pending.append(data)
+        if len(pending) == 1:
+            asyncio.get_event_loop().call_soon(self.input_pending)
+
+    def input_pending(self):
+        pending = self.pending
+        self.pending = []
+        convs, readable, rejected = input_batch(pending, self.kcps)
+        self.kcps_received(convs, readable)
+        for i in rejected:
+            self.packet_received(pending[i])
+
+    def datagrams_received(self, receiver):
+        convs, readable, rejected = receiver.input(self.kcps)
+        self.kcps_received(convs, readable)
+        for i in rejected:
+            self.packet_received(receiver.packet(i))
+
+    def packet_received(self, data):
         conv = get_conv(data)
         sessions = self.sessions
         if conv in sessions:
-            session = sessions[conv]
-            kcp = session.kcp
-            kcp.input(data, len(data))
-            peeksize = kcp.peeksize()
-            if peeksize != 0 and peeksize != -1:
-                data = bytes(peeksize)
-                kcp.recv(data, peeksize)
-                kcp.flush()
-                session.protocol.data_received(data)
-            self.active_sessions.add(conv)
-        else:
-            if not self.is_local:
-                if conv not in self.accept_dict:
-                    loop = asyncio.get_event_loop()
-                    loop.create_task(self.accept_connection(conv))
-                    self.accept_dict[conv].extend(data)
-                else:
-                    data_len = len(data)
-                    buffer = len(self.accept_dict[conv])
-                    if buffer + data_len > 65536:
-                        del self.accept_dict[conv]
-                    else:
-                        self.accept_dict[conv].extend(data)
+            sessions[conv].kcp.input(data, len(data))
+            self.kcp_received(conv)
+        elif not self.is_local and is_handshake(data, KCPConfig().fec_data > 0):
+            self.accept_connection(conv, data)
+
+    def kcp_received(self, conv):
+        updater.receive(self.sessions[conv])
+        updater.activate(self, conv, True)
+
+    def kcps_received(self, convs, readable):
+        """deliver the readable sessions and flush every session that took input on the next update"""
+        sessions = self.sessions
+        for conv in readable:
+            updater.receive(sessions[conv])
+        for conv in convs:
+            updater.activate(self, conv, True)
+
+    def reap(self, now, timeout):
+        """close sessions whose kcp has been idle for longer than timeout seconds"""
+        for conv in self.group.expired(now, timeout * 1000):
+            logging.info("session %s idle for %ss, closing", conv, timeout)
+            self.close_session(self.sessions[conv])
+
+    def reaping(self):
+        loop = asyncio.get_event_loop()
+        self.reap(kcp_now(), KCPConfig().idle_timeout)
+        self.reaper = loop.call_later(REAP_INTERVAL, self.reaping)
 
     def connection_lost(self, exc):
         logging.info("connection lost for: %s", exc)
-        updater.unregister(self)
+        if self.reaper is not None:
+            self.reaper.cancel()
         sessions = self.sessions
         for session in sessions.values():
             session.protocol.eof_received()
             session.protocol.connection_lost(exc)
         sessions.clear()
-        self.accept_dict.clear()
+        self.group.clear()
+        self.pending.clear()
         del sessions
 
     def close_session(self, session):
         conv = session.conv
         del self.sessions[conv]
-        if conv in self.active_sessions:
-            self.active_sessions.remove(conv)
+        self.group.remove(conv)
+        session.protocol.eof_received()
+        session.protocol.connection_lost(None)
 
     def error_received(self, exc):
         logging.warning("conn received error %s", exc)
 
 
 class ServerDataGramHandlerProtocol(protocols.DatagramProtocol):
-    conns = defaultdict(bytearray)
+    """
+    serves every client on the listening socket. packets are routed by address
+    to a per peer DataGramConnHandlerProtocol and by conv to its session.
+    """
 
-    def __init__(self, client_connected_cb):
-        self.client_connected_cb = client_connected_cb
+    def __init__(self, protocol_factory):
+        self.protocol_factory = protocol_factory
         self.transport = None
+        self.peers = dict()
+        self.routes = dict()
+        self.reaper = None
 
     def connection_made(self, transport: transports.DatagramTransport):
         self.transport = transport
+        self.reaper = asyncio.get_event_loop().call_later(REAP_INTERVAL, self.reaping)
+
+    def get_peer(self, data, addr):
+        """the peer at addr, a new one only when data is a handshake. None drops data"""
+        peer = self.peers.get(addr)
+        if peer is None and is_handshake(data, KCPConfig().fec_data > 0):
+            peer = DataGramConnHandlerProtocol(is_local=False, protocol_factory=self.protocol_factory,
+                                               address=addr)
+            peer.connection_made(self.transport)
+            self.peers[addr] = peer
+            self.routes[addr] = peer.kcps
+        return peer
 
     def datagram_received(self, data: bytes, addr):
+        peer = self.get_peer(data, addr)
+        if peer is not None:
+            peer.datagram_received(data, addr)
+
+    def datagrams_received(self, receiver):
+        keys, readable, rejected = receiver.demux(self.routes)
+        peers = self.peers
+        for addr, conv in readable:
+            updater.receive(peers[addr].sessions[conv])
+        for addr, conv in keys:
+            updater.activate(peers[addr], conv, True)
+        for i in rejected:
+            data = receiver.packet(i)
+            peer = self.get_peer(data, receiver.address(i))
+            if peer is not None:
+                peer.packet_received(data)
+
+    def reaping(self):
         loop = asyncio.get_event_loop()
-        conns = self.conns
-
-        def connection_accepted_cb(result: asyncio.Future):
-            if not result.exception():
-                transport, protocol = result.result()
-                buffer = conns[addr]
-                protocol.datagram_received(buffer, addr)
-
-        if addr not in conns:
-            task = loop.create_task(loop.create_datagram_endpoint(
-                lambda: DataGramConnHandlerProtocol(is_local=False, client_connected_cb=self.client_connected_cb),
-                local_addr=self.transport.get_extra_info('sockname'),
-                remote_addr=addr,
-                reuse_address=True,
-                reuse_port=True
-            ))
-            task.add_done_callback(connection_accepted_cb)
-        self.conns[addr].extend(data)
+        now = kcp_now()
+        timeout = KCPConfig().idle_timeout
+        for addr, peer in list(self.peers.items()):
+            peer.reap(now, timeout)
+            # a new peer has no session until its pending handshake is input
+            if not peer.sessions and not peer.pending:
+                del self.peers[addr]
+                del self.routes[addr]
+        self.reaper = loop.call_later(REAP_INTERVAL, self.reaping)
 
     def connection_lost(self, exc):
         logging.info("server connection lost: %s", exc)
+        if self.reaper is not None:
+            self.reaper.cancel()
+        for peer in self.peers.values():
+            peer.connection_lost(exc)
+        self.peers.clear()
+        self.routes.clear()
 
     def error_received(self, exc):
         logging.warning("server error: %s", exc)
@@ -8,35 +8,43 @@ import sys
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../'))
 
 from kcp import utils
+from kcp.endpoint import create_endpoint
 from kcp.protocols import ServerDataGramHandlerProtocol
 from kcp.pipe import open_pipe
 from kcp.updater import updater
+from kcp.workers import run_workers
 
 
-async def server_main():
+async def server_main(config):
     loop = asyncio.get_event_loop()
-    config = utils.get_config(False)
 
-    def ds_factory():
-        return asyncio.open_connection(host=config.server, port=config.server_port)
+    def connect(protocol):
+        return loop.create_connection(lambda: protocol, host=config.server, port=config.server_port)
 
-    protocol = ServerDataGramHandlerProtocol(functools.partial(open_pipe, ds_factory=ds_factory))
-    await loop.create_datagram_endpoint(lambda: protocol, local_addr=(config.local, config.local_port))
+    protocol = ServerDataGramHandlerProtocol(functools.partial(open_pipe, connect))
+    await create_endpoint(lambda: protocol, local_addr=(config.local, config.local_port),
+                          reuse_port=config.workers > 1)
     logging.info("start server at %s:%s", config.local, config.local_port)
     updater.load_config(config)
     updater.run()
     for signame in {'SIGQUIT', 'SIGTERM'}:
         loop.add_signal_handler(
-            getattr(signal, signame), lambda: asyncio.ensure_future(utils.shutdown(signame, loop)))
+            getattr(signal, signame), lambda signame=signame: asyncio.ensure_future(utils.shutdown(signame, loop)))
     e = asyncio.Event()
     try:
         await e.wait()
+    except asyncio.CancelledError:
+        pass
     except KeyboardInterrupt:
         await utils.shutdown('KeyboardInterrupt', loop)
 
 
 def main():
-    asyncio.run(server_main())
+    config = utils.get_config(False)
+    if config.workers > 1:
+        run_workers(lambda: asyncio.run(server_main(config)), config.workers)
+    else:
+        asyncio.run(server_main(config))
 
 
 if __name__ == '__main__':
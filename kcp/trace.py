@@ -0,0 +1,122 @@
+import argparse
+import mmap
+import struct
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+HEADER = struct.Struct('=8sIIQQ')
+RECORD = struct.Struct('=QIIIIHHBBBx')
+MAGIC = b'KCPTRACE'
+
+IKCP_CMD_PUSH = 81
+IKCP_CMD_ACK = 82
+IKCP_CMD_WASK = 83
+IKCP_CMD_WINS = 84
+TRACE_IN = 0
+TRACE_OUT = 1
+
+
+class TraceError(Exception):
+    """not a kcp trace file"""
+
+
+def read_records(path):
+    """yield (time_us, conv, sn, una, ts, wnd, length, cmd, frg, direction) from oldest to newest"""
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as ring:
+        magic, version, record_size, capacity, head = HEADER.unpack_from(ring)
+        if magic != MAGIC or version != 1 or record_size != RECORD.size:
+            raise TraceError(path)
+        count = min(head, capacity)
+        first = head - count
+        for i in range(first, head):
+            yield RECORD.unpack_from(ring, HEADER.size + (i % capacity) * RECORD.size)
+
+
+@dataclass
+class ConvSummary:
+    sent: int = 0
+    retransmits: int = 0
+    received: int = 0
+    duplicates: int = 0
+    reordered: int = 0
+    acks_in: int = 0
+    acks_out: int = 0
+    probes: int = 0
+    wins: int = 0
+    rtts: list = field(default_factory=list)
+    sent_sns: set = field(default_factory=set)
+    received_sns: set = field(default_factory=set)
+    max_sn: int = -1
+
+
+def summarize(records):
+    convs = defaultdict(ConvSummary)
+    span = [None, None]
+    for time, conv, sn, una, ts, wnd, length, cmd, frg, direction in records:
+        if span[0] is None:
+            span[0] = time
+        span[1] = time
+        summary = convs[conv]
+        if cmd == IKCP_CMD_PUSH:
+            if direction == TRACE_OUT:
+                summary.sent += 1
+                if sn in summary.sent_sns:
+                    summary.retransmits += 1
+                summary.sent_sns.add(sn)
+            else:
+                summary.received += 1
+                if sn in summary.received_sns:
+                    summary.duplicates += 1
+                elif sn < summary.max_sn:
+                    summary.reordered += 1
+                summary.received_sns.add(sn)
+                summary.max_sn = max(summary.max_sn, sn)
+        elif cmd == IKCP_CMD_ACK:
+            if direction == TRACE_OUT:
+                summary.acks_out += 1
+            else:
+                summary.acks_in += 1
+                # acks echo the kcp clock of the segment they acknowledge
+                rtt = ((time // 1000) - ts) & 0xffffffff
+                if rtt < 0x80000000:
+                    summary.rtts.append(rtt)
+        elif cmd == IKCP_CMD_WASK:
+            summary.probes += 1
+        elif cmd == IKCP_CMD_WINS:
+            summary.wins += 1
+    return convs, span
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(convs, span, total):
+    seconds = (span[1] - span[0]) / 1e6 if total else 0
+    print(f'{total} segments over {seconds:.3f}s, {len(convs)} convs')
+    print(f'{"conv":>10} {"sent":>8} {"retrans":>8} {"ratio":>6} {"recv":>8} {"dup":>6} {"reorder":>7} '
+          f'{"ack in":>7} {"ack out":>7} {"probe":>5} {"wins":>5} {"rtt min/p50/p99/max ms":>24}')
+    for conv in sorted(convs, key=lambda c: convs[c].retransmits, reverse=True):
+        summary = convs[conv]
+        ratio = summary.retransmits / summary.sent if summary.sent else 0
+        rtts = sorted(summary.rtts)
+        rtt = (f'{rtts[0]}/{percentile(rtts, 0.5)}/{percentile(rtts, 0.99)}/{rtts[-1]}' if rtts else '-')
+        print(f'{conv:>10} {summary.sent:>8} {summary.retransmits:>8} {ratio:>6.1%} {summary.received:>8} '
+              f'{summary.duplicates:>6} {summary.reordered:>7} {summary.acks_in:>7} {summary.acks_out:>7} '
+              f'{summary.probes:>5} {summary.wins:>5} {rtt:>24}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a KCP packet trace.')
+    parser.add_argument('path', help='trace file written with --trace')
+    parser.add_argument('--conv', help='only show this conv', type=int)
+    args = parser.parse_args()
+    records = list(read_records(args.path))
+    if args.conv is not None:
+        records = [record for record in records if record[1] == args.conv]
+    convs, span = summarize(records)
+    report(convs, span, len(records))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,53 +1,166 @@
 import asyncio
+import heapq
+import itertools
+import os
 
-from KCP import kcp_now
+from kcp.KCP import kcp_now, start_engine, trace_start, update_groups
 
 
 class Updater:
+    """
+    deadline driven scheduler for kcp tunnels.
+
+    every tunnel keeps its sessions in a ``KCPGroup`` and is kept in a heap keyed
+    on the loop time of the group's earliest ``kcp.check`` deadline. tunnels with
+    sessions that got input or output are updated on the next loop iteration.
+    sessions that took input are flushed on that iteration too, so their acks
+    and replies leave together without waiting for the interval.
+    tunnels whose sessions are all idle are not scheduled at all, so the updater
+    does not wake up when there is nothing to do. all due tunnels are updated by
+    one ``update_groups`` call, spread over the engine threads with ``--threads``.
+    transports holding coalesced writes are flushed first, at most one interval late.
+    """
 
     def __init__(self):
-        self.tunnels = set()
+        self.active_tunnels = set()
         self.interval = 0.05
-        self.raw_interval = 50
-        self.register = self.tunnels.add
-        self.unregister = self.tunnels.remove
+        self.deadlines = []
+        self.counter = itertools.count()
+        self.loop = None
+        self.handle = None
+        self.kicked = False
+        self.writes = set()
+        self.buffer = bytearray(65536)
+        self.view = memoryview(self.buffer)
+
+    def receive(self, session):
+        """
+        deliver everything waiting in the session's rcv_queue. an asyncio.BufferedProtocol
+        gets it drained straight into its get_buffer when the buffer holds the next
+        message, other protocols get bytes they may keep. nothing is delivered while
+        the stream has paused reading.
+        """
+        if not session.transport.is_reading():
+            return False
+        kcp = session.kcp
+        protocol = session.protocol
+        peeksize = kcp.peeksize()
+        if peeksize < 0:
+            return False
+        if isinstance(protocol, asyncio.BufferedProtocol):
+            buffer = protocol.get_buffer(peeksize)
+            if len(buffer) >= peeksize:
+                size = kcp.drain_into(buffer)
+                if size:
+                    protocol.buffer_updated(size)
+                return True
+        if peeksize > len(self.buffer):
+            self.buffer = bytearray(peeksize)
+            self.view = memoryview(self.buffer)
+        size = kcp.drain_into(self.buffer)
+        if not size:
+            return True
+        if isinstance(protocol, asyncio.BufferedProtocol):
+            self.feed(protocol, self.view[:size])
+        else:
+            protocol.data_received(bytes(self.view[:size]))
+        return True
+
+    @staticmethod
+    def feed(protocol, data):
+        """copy data into the buffers of a BufferedProtocol"""
+        while data:
+            buffer = protocol.get_buffer(len(data))
+            size = min(len(buffer), len(data))
+            buffer[:size] = data[:size]
+            protocol.buffer_updated(size)
+            data = data[size:]
+
+    def activate(self, tunnel, conv, flush=False):
+        tunnel.group.activate(conv, flush)
+        self.active_tunnels.add(tunnel)
+        if not self.kicked:
+            self.kicked = True
+            if self.handle is not None:
+                self.handle.cancel()
+            self.handle = self.loop.call_soon(self.update)
+
+    def defer(self, transport):
+        """call transport.write_pending on the next tick, within one interval"""
+        writes = self.writes
+        writes.add(transport)
+        if len(writes) > 1 or self.kicked:
+            return
+        when = self.loop.time() + self.interval
+        if self.handle is None or self.handle.when() > when:
+            if self.handle is not None:
+                self.handle.cancel()
+            self.handle = self.loop.call_at(when, self.update)
 
     def update(self):
-        for tunnel in self.tunnels:
-            now = kcp_now()
+        self.handle = None
+        writes = self.writes
+        if writes:
+            self.writes = set()
+            # keep activate from scheduling another update while the writes are queued
+            self.kicked = True
+            for transport in writes:
+                transport.write_pending()
+        self.kicked = False
+        loop = self.loop
+        deadlines = self.deadlines
+        heappop = heapq.heappop
+        heappush = heapq.heappush
+        counter = self.counter
+        now = kcp_now()
+        time = loop.time()
+        active_tunnels = self.active_tunnels
+        while deadlines and deadlines[0][0] <= time:
+            when, _, tunnel = heappop(deadlines)
+            if tunnel.next_update == when:
+                active_tunnels.add(tunnel)
+        self.active_tunnels = set()
+        tunnels = list(active_tunnels)
+        results = update_groups([tunnel.group for tunnel in tunnels], now)
+        for tunnel, (readable, writable, dead, delay) in zip(tunnels, results):
             sessions = tunnel.sessions
-            active = tunnel.active_sessions
-            active_pop = active.pop
-            active_add = active.add
-            try:
-                conv = active_pop()
+            for conv in dead:
+                tunnel.close_session(sessions[conv])
+            for conv in writable:
+                sessions[conv].transport.maybe_resume_protocol()
+            for conv in readable:
                 session = sessions[conv]
-                kcp = session.kcp
-                kcp.update(now)
-                if kcp.state == -1:
-                    tunnel.close_session(session)
-                else:
-                    peeksize = kcp.peeksize()
-                    if peeksize != 0 and peeksize != -1:
-                        data = bytes(peeksize)
-                        kcp.recv(data, peeksize)
-                        session.protocol.data_received(data)
-                    next_call = kcp.check(now)
-                    session.next_update = next_call
-            except KeyError:
-                raw_interval = self.raw_interval
-                for session in sessions.values():
-                    if session.next_update - now < raw_interval:
-                        active_add(session.conv)
-        asyncio.get_event_loop().call_later(self.interval, self.update)
+                if self.receive(session):
+                    while self.receive(session):
+                        pass
+                    # the drained rcv_queue may reopen the window, flush it to the peer
+                    self.activate(tunnel, conv, True)
+            if delay < 0:
+                tunnel.next_update = None
+                continue
+            when = time + delay / 1000
+            tunnel.next_update = when
+            heappush(deadlines, (when, next(counter), tunnel))
+        if self.kicked:
+            return
+        when = deadlines[0][0] if deadlines else None
+        if self.writes and (when is None or when > time + self.interval):
+            when = time + self.interval
+        if when is not None:
+            if self.handle is not None:
+                self.handle.cancel()
+            self.handle = loop.call_at(when, self.update)
 
     def load_config(self, config):
-        self.raw_interval = config.interval
         self.interval = config.interval / 1000
+        if config.threads > 1:
+            start_engine(config.threads)
+        if config.trace:
+            trace_start(config.trace if config.workers == 1 else f'{config.trace}.{os.getpid()}')
 
     def run(self):
-        loop = asyncio.get_event_loop()
-        loop.call_soon(self.update)
+        self.loop = asyncio.get_event_loop()
+        self.loop.call_soon(self.update)
 
 
 updater = Updater()
@@ -16,12 +16,10 @@ def check_python():
 
 async def shutdown(signame, loop):
     logging.info('caught {0}'.format(signame))
-    tasks = [task for task in asyncio.Task.all_tasks() if task is not
-             asyncio.tasks.Task.current_task()]
+    tasks = [task for task in asyncio.all_tasks(loop) if task is not asyncio.current_task()]
     list(map(lambda task: task.cancel(), tasks))
     results = await asyncio.gather(*tasks, return_exceptions=True)
-    logging.info('finished awaiting cancelled tasks, results: %s'.format(results))
-    loop.stop()
+    logging.info('finished awaiting cancelled tasks, results: %s', results)
 
 
 def singleton(cls):
@@ -51,6 +49,23 @@ class KCPConfig:
     nodelay: bool
     nc: int
     resend: int
+    batch: int
+    recvmmsg: int
+    idle_timeout: int
+    workers: int
+    threads: int
+    trace: str
+    stream: int
+    coalesce: int
+    offload: int
+    pacing: int
+    pacing_rate: int
+    congestion: str
+    autotune: int
+    autotune_min: int
+    fec_data: int
+    fec_parity: int
+    compress: int
 
 
 def get_config(is_local):
@@ -60,7 +75,11 @@ def get_config(is_local):
         description='Python binding KCP tunnel {}.'.format('Local' if is_local else 'Server'))
     config_attr = ['server', 'server_port', 'local', 'local_port',
                    'sndwnd', 'rcvwnd', 'mtu',
-                   'interval', 'nodelay', 'resend', 'nc']
+                   'interval', 'nodelay', 'resend', 'nc', 'batch', 'recvmmsg', 'idle_timeout',
+                   'workers', 'threads', 'trace',
+                   'stream', 'coalesce', 'offload', 'pacing', 'pacing_rate',
+                   'congestion', 'autotune', 'autotune_min',
+                   'fec_data', 'fec_parity', 'compress']
     parser.add_argument('-s', '--server', help='Host name or IP address of your remote server.')
     parser.add_argument('-p', '--server_port', help='Port number of your remote server.', type=int)
     parser.add_argument('-l', '--local', help='Host name or IP address your local server')
@@ -105,6 +124,102 @@ def get_config(is_local):
         type=int,
         default=0,
         choices=[0, 1])
+    parser.add_argument(
+        '--batch',
+        help='send KCP output in batches with sendmmsg (default: 0 disable)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--recvmmsg',
+        help='receive UDP packets in batches with recvmmsg (default: 0 disable)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--idle_timeout',
+        help='seconds before an idle KCP session is closed (default 600)',
+        type=int,
+        default=600)
+    parser.add_argument(
+        '--workers',
+        help='number of worker processes sharing the ports with SO_REUSEPORT (default 1)',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--threads',
+        help='number of threads sharing the KCP updates of a process (default 1)',
+        type=int,
+        default=1)
+    parser.add_argument(
+        '--trace',
+        help='write a ring of every KCP segment to this file, read it with kcp_trace')
+    parser.add_argument(
+        '--stream',
+        help='KCP stream mode, small writes share segments (default: 0 message mode)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--coalesce',
+        help='hold writes smaller than a segment until the next update (default: 0 disable)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--offload',
+        help='UDP GSO/GRO segmentation offload on Linux, with --batch and --recvmmsg (default: 0 disable)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--pacing',
+        help='spread KCP data packets over the RTT instead of sending a window at once, with --batch (default: 0 disable)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--pacing_rate',
+        help='cap of the pacing rate in KB/s (default: 0 no cap)',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--congestion',
+        help='congestion control, kcp as set by --nc or bbr paced on delivery rate and min RTT, with --batch '
+             '(default: kcp)',
+        default='kcp',
+        choices=['kcp', 'bbr'])
+    parser.add_argument(
+        '--autotune',
+        help='tune the windows of each session from its delivery rate and RTT, '
+             'between --autotune_min and --sndwnd/--rcvwnd (default: 0 disable)',
+        type=int,
+        default=0,
+        choices=[0, 1])
+    parser.add_argument(
+        '--autotune_min',
+        help='smallest window of --autotune in segments (default 32)',
+        type=int,
+        default=32)
+    parser.add_argument(
+        '--fec_data',
+        help='forward error correction, data shards per group, both ends must match (default: 0 disable)',
+        type=int,
+        default=0)
+    parser.add_argument(
+        '--fec_parity',
+        help='Reed-Solomon parity shards per group of --fec_data. a group cut short by the end of a '
+             'burst after n data shards gets min(n, --fec_parity) of them, so a lone packet is sent '
+             'with one parity shard (default 3)',
+        type=int,
+        default=3)
+    parser.add_argument(
+        '--compress',
+        help='zlib level of the streams, incompressible data is sent as is, both ends must match '
+             '(default: 0 disable)',
+        type=int,
+        default=0,
+        choices=range(10))
     args = parser.parse_args()
     if args.config:
         try:
@@ -122,4 +237,12 @@ def get_config(is_local):
         except IOError:
             logging.exception("error loading config file")
             exit(1)
+    if not args.batch and (args.pacing or args.pacing_rate or args.congestion != 'kcp'):
+        parser.error('--pacing, --pacing_rate and --congestion bbr need --batch 1')
+    if args.offload and not args.recvmmsg:
+        parser.error('--offload needs --recvmmsg 1')
+    if args.fec_data < 0:
+        parser.error('--fec_data must be at least 0')
+    if args.fec_data and (args.fec_parity < 1 or args.fec_data + args.fec_parity > 64):
+        parser.error('--fec_parity must be at least 1 and --fec_data plus --fec_parity at most 64')
     return KCPConfig(**{k: getattr(args, k) for k in config_attr})
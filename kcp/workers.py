@@ -0,0 +1,57 @@
+import asyncio
+import logging
+import os
+import signal
+import time
+
+RESTART_DELAY = 1
+
+
+def run_workers(target, count):
+    """
+    run target in count forked worker processes and restart the ones that exit.
+
+    SIGTERM, SIGQUIT and SIGINT stop the workers, the parent returns once all of them are gone.
+    """
+    workers = dict()
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            for signum in (signal.SIGTERM, signal.SIGQUIT):
+                signal.signal(signum, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            try:
+                target()
+            except (KeyboardInterrupt, asyncio.CancelledError):
+                pass
+            except BaseException:
+                logging.exception("worker %s failed", index)
+                os._exit(1)
+            os._exit(0)
+        workers[pid] = index
+        logging.info("worker %s started with pid %s", index, pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for signum in (signal.SIGTERM, signal.SIGQUIT, signal.SIGINT):
+        signal.signal(signum, stop)
+    for index in range(count):
+        spawn(index)
+    while workers:
+        pid, status = os.wait()
+        index = workers.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logging.warning("worker %s exited with status %s, restarting", index, status)
+        time.sleep(RESTART_DELAY)
+        if not stopping:
+            spawn(index)
@@ -17,6 +17,7 @@ setup(
     [console_scripts]
     kcp_local = kcp.local:main
     kcp_server = kcp.server:main
+    kcp_trace = kcp.trace:main
     """,
     classifiers=[
         'Programming Language :: Python :: 3.7'
@@ -0,0 +1,7 @@
+from kcp.utils import KCPConfig
+
+# KCPConfig is a singleton, the first instance is the config of every test
+KCPConfig(server='127.0.0.1', server_port=0, local='127.0.0.1', local_port=0, sndwnd=128, rcvwnd=512,
+          mtu=1300, interval=10, nodelay=True, nc=1, resend=2, batch=1, recvmmsg=1, idle_timeout=600,
+          workers=1, threads=1, trace='', stream=1, coalesce=0, offload=0, pacing=0, pacing_rate=0,
+          congestion='kcp', autotune=0, autotune_min=32, fec_data=0, fec_parity=3, compress=0)
@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import os
+
+import pytest
+
+from kcp.endpoint import create_endpoint
+from kcp.pipe import open_pipe
+from kcp.protocols import DataGramConnHandlerProtocol, ServerDataGramHandlerProtocol
+from kcp.updater import updater
+from kcp.utils import KCPConfig
+
+
+async def open_tunnel(upstream):
+    """a server and a local endpoint on loopback, returns the port of the local listener and a closer"""
+    loop = asyncio.get_event_loop()
+    upstream_port = upstream.sockets[0].getsockname()[1]
+
+    def connect(protocol):
+        return loop.create_connection(lambda: protocol, host='127.0.0.1', port=upstream_port)
+
+    server_transport, _ = await create_endpoint(
+        lambda: ServerDataGramHandlerProtocol(functools.partial(open_pipe, connect)), local_addr=('127.0.0.1', 0))
+    local_transport, local = await create_endpoint(
+        lambda: DataGramConnHandlerProtocol(is_local=True),
+        remote_addr=('127.0.0.1', server_transport.get_extra_info('sockname')[1]))
+    listener = await loop.create_server(functools.partial(open_pipe, local.open_session), host='127.0.0.1', port=0)
+    updater.load_config(KCPConfig())
+    updater.run()
+
+    def close():
+        listener.close()
+        local_transport.close()
+        server_transport.close()
+
+    return listener.sockets[0].getsockname()[1], close
+
+
+@pytest.mark.parametrize('size', [1000, 3 << 20])
+def test_reply_then_close(size):
+    payload = os.urandom(size)
+
+    async def reply(reader, writer):
+        # closing with the request unread would reset the connection
+        await reader.readexactly(5)
+        writer.write(payload)
+        writer.close()
+
+    async def main():
+        upstream = await asyncio.start_server(reply, host='127.0.0.1', port=0)
+        port, close = await open_tunnel(upstream)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'hello')
+            assert await asyncio.wait_for(reader.readexactly(size), 30) == payload
+            writer.close()
+        finally:
+            close()
+            upstream.close()
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('size', [1000, 3 << 20])
+def test_send_then_close(size):
+    payload = os.urandom(size)
+
+    async def main():
+        done = asyncio.Queue()
+
+        async def sink(reader, writer):
+            done.put_nowait(await reader.readexactly(size))
+
+        upstream = await asyncio.start_server(sink, host='127.0.0.1', port=0)
+        port, close = await open_tunnel(upstream)
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(payload)
+            writer.close()
+            assert await asyncio.wait_for(done.get(), 30) == payload
+        finally:
+            close()
+            upstream.close()
+
+    asyncio.run(main())
@@ -0,0 +1,90 @@
+import asyncio
+import os
+import zlib
+
+from kcp.compress import DEFLATE, FRAME_BYTES, HEADER_BYTES, RAW, THREAD_BYTES, Deflater, Inflater, frame
+
+
+class Sink:
+    def __init__(self):
+        self.data = bytearray()
+        self.lost = False
+
+    def data_received(self, data):
+        self.data += data
+
+    def connection_lost(self, exc):
+        self.lost = True
+
+
+def test_frame():
+    assert frame(RAW, b'abc') == b'\x00\x00\x00\x03abc'
+    assert frame(DEFLATE, b'x' * 0x10203)[:HEADER_BYTES] == b'\x01\x01\x02\x03'
+
+
+def test_round_trip():
+    writes = [b'hello', b'text ' * 1000, os.urandom(5000), b'0123456789' * (FRAME_BYTES // 4), os.urandom(THREAD_BYTES)]
+    frames = []
+    errors = []
+    sink = Sink()
+
+    async def main():
+        deflater = Deflater(frames.append, 6, lambda busy: None, errors.append)
+        inflater = Inflater(sink, lambda busy: None, errors.append)
+        for data in writes:
+            deflater.write(data)
+        while deflater.busy:
+            await asyncio.sleep(0.01)
+        # frames may arrive split anywhere
+        stream = b''.join(frames)
+        for start in range(0, len(stream), 1000):
+            inflater.data_received(stream[start:start + 1000])
+            while inflater.running:
+                await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert errors == []
+    assert sink.data == b''.join(writes)
+    kinds = [f[0] for f in frames]
+    assert kinds[0] == RAW and DEFLATE in kinds
+    # writes are cut into frames of FRAME_BYTES at most
+    assert len(frames) == 7
+
+
+def test_inflate_bound():
+    deflater = zlib.compressobj()
+    bomb = deflater.compress(bytes(10 * FRAME_BYTES)) + deflater.flush(zlib.Z_SYNC_FLUSH)
+    errors = []
+    sink = Sink()
+    inflater = Inflater(sink, lambda busy: None, errors.append)
+    inflater.data_received(frame(DEFLATE, bomb))
+    assert len(errors) == 1 and isinstance(errors[0], zlib.error)
+    assert inflater.stopped and sink.data == b''
+    inflater.data_received(frame(RAW, b'late'))
+    assert sink.data == b''
+    inflater.connection_lost(None)
+    assert sink.lost
+
+
+def test_deflate_error():
+    class Broken:
+        def compress(self, data):
+            raise MemoryError()
+
+    frames = []
+    errors = []
+    busy = []
+
+    async def main():
+        deflater = Deflater(frames.append, 6, busy.append, errors.append)
+        deflater.deflater = Broken()
+        deflater.write(bytes(THREAD_BYTES))
+        deflater.write(b'queued')
+        while deflater.running:
+            await asyncio.sleep(0.01)
+        deflater.write(b'ignored')
+        assert not deflater.busy
+
+    asyncio.run(main())
+    assert frames == [] and busy == [True]
+    assert len(errors) == 1 and isinstance(errors[0], MemoryError)
@@ -0,0 +1,73 @@
+import os
+
+import pytest
+
+from kcp.KCP import KCP, kcp_now
+
+DATA = 0xf1
+PARITY = 0xf2
+
+
+def new_pair(data, parity):
+    sent = []
+    a, b = KCP(7), KCP(7)
+    a.set_output(sent.append)
+    b.set_output(lambda packet: None)
+    for k in (a, b):
+        k.set_mtu(1400)
+        k.set_fec(data, parity)
+        k.nodelay(1, 10, 2, 1)
+    return a, b, sent
+
+
+def transfer(a, b, sent, payload, drop):
+    """send payload from a to b losing the data shards at the indexes in drop, returns what b received"""
+    a.send(payload, len(payload))
+    a.update(kcp_now())
+    data_index = 0
+    for packet in sent:
+        if packet[8] == DATA:
+            data_index += 1
+            if data_index - 1 in drop:
+                continue
+        b.input(packet, len(packet))
+    buf = bytearray(len(payload) + 1)
+    n = b.recv_into(buf)
+    return bytes(buf[:max(n, 0)])
+
+
+def test_full_group_recovers():
+    a, b, sent = new_pair(4, 2)
+    payload = os.urandom(a.mss * 4)
+    assert transfer(a, b, sent, payload, {1, 2}) == payload
+    assert [packet[8] for packet in sent] == [DATA] * 4 + [PARITY] * 2
+    assert b.stats()['recovered'] == 2
+
+
+def test_partial_group_recovers():
+    a, b, sent = new_pair(4, 3)
+    payload = os.urandom(a.mss * 2)
+    assert transfer(a, b, sent, payload, {0}) == payload
+    # a group cut short after n data shards sends at most n parity shards
+    assert [packet[8] for packet in sent] == [DATA] * 2 + [PARITY] * 2
+    assert b.stats()['recovered'] == 1
+
+
+def test_single_packet_recovers_from_parity():
+    a, b, sent = new_pair(10, 3)
+    assert transfer(a, b, sent, b'hello', {0}) == b'hello'
+    assert [packet[8] for packet in sent] == [DATA, PARITY]
+    assert b.stats()['recovered'] == 1
+
+
+def test_too_much_loss():
+    a, b, sent = new_pair(4, 2)
+    payload = os.urandom(a.mss * 4)
+    assert transfer(a, b, sent, payload, {0, 1, 2}) == b''
+    assert b.stats()['recovered'] == 0
+
+
+@pytest.mark.parametrize('data, parity', [(-1, 1), (1, 0), (60, 5)])
+def test_set_fec_rejects(data, parity):
+    with pytest.raises(ValueError):
+        KCP(7).set_fec(data, parity)
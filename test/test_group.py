@@ -0,0 +1,92 @@
+import pytest
+
+from kcp.KCP import KCP, KCPGroup, STATS_FIELDS, kcp_now
+
+
+def new_kcp(conv, sent=None):
+    kcp = KCP(conv)
+    kcp.set_output(sent.append if sent is not None else lambda data: None)
+    kcp.nodelay(1, 10, 2, 1)
+    return kcp
+
+
+def stats_convs(group):
+    rows = group.stats()
+    width = len(STATS_FIELDS)
+    return {rows[i] for i in range(0, len(rows), width)}
+
+
+def test_add_remove():
+    group = KCPGroup()
+    for conv in (1, 2, 3, 4):
+        group.add(new_kcp(conv))
+    with pytest.raises(ValueError):
+        group.add(new_kcp(2))
+    # the last entry moves into the hole, the index has to follow it
+    group.remove(1)
+    assert len(group) == 3
+    assert set(group.kcps) == {2, 3, 4} == stats_convs(group)
+    group.remove(4)
+    group.remove(2)
+    assert set(group.kcps) == {3} == stats_convs(group)
+    group.add(new_kcp(1))
+    assert stats_convs(group) == {1, 3}
+    with pytest.raises(KeyError):
+        group.remove(2)
+    group.clear()
+    assert len(group) == 0
+
+
+def test_update_reports_events():
+    sent = []
+    group = KCPGroup()
+    sender, receiver = new_kcp(1, sent), new_kcp(1)
+    group.add(receiver)
+    group.add(new_kcp(2))
+    now = kcp_now()
+    sender.send(b'hello', 5)
+    sender.update(now)
+    for packet in sent:
+        receiver.input(packet, len(packet))
+    group.activate(1)
+    readable, writable, dead, delay = group.update(now)
+    assert readable == [1] and dead == []
+    receiver.state = -1
+    group.activate(1)
+    readable, writable, dead, delay = group.update(now)
+    assert dead == [1]
+
+
+def test_expired():
+    group = KCPGroup()
+    group.add(new_kcp(1))
+    group.add(new_kcp(2))
+    now = kcp_now()
+    readable, writable, dead, delay = group.update(now)
+    assert delay == -1
+    assert sorted(group.expired(now + 1001, 1000)) == [1, 2]
+    assert group.expired(now + 999, 1000) == []
+    group.activate(1)
+    assert group.expired(now + 1001, 1000) == [2]
+
+
+def test_close_waits_for_acks():
+    sent = []
+    group = KCPGroup()
+    sender, receiver = new_kcp(1, sent), new_kcp(1)
+    group.add(sender)
+    now = kcp_now()
+    sender.send(b'x' * 3000, 3000)
+    group.close(1)
+    readable, writable, dead, delay = group.update(now)
+    assert dead == [] and sender.waitsnd() > 0
+    acks = []
+    receiver.set_output(acks.append)
+    for packet in sent:
+        receiver.input(packet, len(packet))
+    receiver.update(now)
+    for packet in acks:
+        sender.input(packet, len(packet))
+    group.activate(1)
+    readable, writable, dead, delay = group.update(now + 10)
+    assert dead == [1]